@@ -0,0 +1,12 @@
+from django import forms
+from django.contrib.auth.forms import AuthenticationForm
+
+
+class ExtendedAuthenticationForm(AuthenticationForm):
+    """
+    The authentication form ``social_registration.views.login()`` expects the
+    project to provide, as a project's ``accounts`` application would.
+
+    """
+    remember = forms.BooleanField(required=False)
+
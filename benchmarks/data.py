@@ -0,0 +1,53 @@
+"""
+The data the benchmarks run against.
+
+"""
+import random
+
+
+# Association ``i`` belongs to user ``user<i>`` and has the service and
+# identifier below, so benchmarks can pick existing rows without a query.
+IDENTIFIER_BASE = 100000000
+SERVICES = ('facebook', 'twitter')
+
+AUTHENTICATE_URLS = {
+    'facebook': 'facebook-authentication',
+    'twitter': 'twitter-authenticate'
+}
+
+
+def existing_identifier(service, size):
+    return IDENTIFIER_BASE + random.randrange(size // 2) * 2 + SERVICES.index(service)
+
+
+def missing_identifier():
+    return random.randrange(1, IDENTIFIER_BASE)
+
+
+def populate(size, chunk_size=75):
+    """
+    Grows the association table to ``size`` rows. Rows are inserted in chunks
+    small enough to stay within SQLite's limit on query parameters.
+
+    """
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from social_registration.models import Association
+
+    @transaction.commit_on_success
+    def insert(start, stop):
+        usernames = ['user%d' % i for i in range(start, stop)]
+        User.objects.bulk_create([User(username=username, email='%s@example.com' % username, password='!')
+            for username in usernames])
+        users = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+        Association.objects.bulk_create([Association(
+            access_token='token',
+            identifier=IDENTIFIER_BASE + i,
+            is_active=True,
+            profile_url='http://example.com/user%d' % i,
+            service=SERVICES[i % 2],
+            user_id=users['user%d' % i]
+        ) for i in range(start, stop)])
+
+    for start in range(Association.objects.count(), size, chunk_size):
+        insert(start, min(start + chunk_size, size))
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+"""
+Drives concurrent logins through the real URLconf, served over HTTP in this
+process, with Twitter and Facebook replaced by the stand-ins in
+``stubs.py``. Three flows are mixed:
+
+    *   new: a new user logs in and completes the setup form.
+    *   returning: an existing user logs in.
+    *   link: an existing user logs in, then links their other service.
+
+Throughput and the 50th, 95th and 99th percentile latency of each flow and
+each view are reported, optionally as JSON::
+
+    python benchmarks/load.py --flows=2000 --concurrency=50 --latency=0.15 --mix=new:1,returning:8,link:1
+
+With ``--gevent`` the site is served by gevent's WSGI server, in a single OS
+thread, after the standard library has been patched to cooperate with it, as
+under ``gunicorn -k gevent``. Every call to the services goes through
+``social_registration.transport``, which uses the standard library's sockets,
+so a login waiting on a service gives way to the others and one worker
+handles as many logins at once as there are flows in flight::
+
+    python benchmarks/load.py --gevent --flows=2000 --concurrency=200 --latency=0.3
+
+The peak number of requests the site handled at once is reported with the
+results.
+
+Unless ``BENCHMARK_DATABASE_NAME`` is set, a temporary SQLite database is
+used; SQLite serializes writes, so point it at the production database
+engine for capacity planning.
+
+"""
+import sys
+
+# The standard library has to be patched before anything else imports it.
+if '--gevent' in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
+import cookielib
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
+import urllib
+import urllib2
+import urlparse
+
+from optparse import OptionParser
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.dirname(ROOT)]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from data import AUTHENTICATE_URLS, IDENTIFIER_BASE, SERVICES, existing_identifier, populate
+from stubs import FacebookHandler, StoppableMixIn, StubServer, TwitterHandler
+
+
+class ThreadingWSGIServer(StoppableMixIn, WSGIServer):
+    pass
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class InFlight(object):
+    """
+    Wraps a WSGI application to count the requests it is handling at once.
+
+    """
+    def __init__(self, application):
+        self.application = application
+        self.current = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        self.lock.acquire()
+        try:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        finally:
+            self.lock.release()
+        try:
+            # Django's responses are rendered in full, but closing them sends
+            # ``request_finished``, which closes the database connection.
+            response = self.application(environ, start_response)
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        finally:
+            self.lock.acquire()
+            try:
+                self.current -= 1
+            finally:
+                self.lock.release()
+
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    """
+    Leaves redirects for the driver to check rather than following them.
+
+    """
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(round((len(values) - 1) * fraction)))]
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    if not durations:
+        return {'count': 0}
+    return {
+        'count': len(durations),
+        'p50': percentile(durations, 0.5) * 1000,
+        'p95': percentile(durations, 0.95) * 1000,
+        'p99': percentile(durations, 0.99) * 1000
+    }
+
+
+class Driver(object):
+    """
+    Runs login flows against the site at ``site_url``, recording how long
+    each flow and each view took, and why any flow failed.
+
+    """
+    def __init__(self, site_url, twitter, facebook, size):
+        self.site_url = site_url
+        self.providers = {'facebook': facebook, 'twitter': twitter}
+        self.size = size
+        self.new_identifiers = itertools.count(IDENTIFIER_BASE * 2)
+        self.flows = {}
+        self.views = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def record(self, timings, name, duration):
+        self.lock.acquire()
+        try:
+            timings.setdefault(name, []).append(duration)
+        finally:
+            self.lock.release()
+
+    def fail(self, flow, error):
+        self.lock.acquire()
+        try:
+            key = '%s: %s' % (flow, error)
+            self.errors[key] = self.errors.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def opener(self):
+        """
+        Return a new browser: a URL opener with its own cookies.
+
+        """
+        return urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()), NoRedirectHandler())
+
+    def request(self, opener, view, path, data=None):
+        """
+        Request a page of the site, recording the time taken against the
+        given view, and return the status and the URL redirected to, if any.
+
+        """
+        start = timeit.default_timer()
+        try:
+            response = opener.open(urlparse.urljoin(self.site_url, path), data and urllib.urlencode(data))
+        except urllib2.HTTPError, e:
+            response = e
+        response.read()
+        response.close()
+        self.record(self.views, view, timeit.default_timer() - start)
+        return response.code, response.info().get('location', '')
+
+    def expect(self, location, name):
+        from django.core.urlresolvers import reverse
+
+        path = urlparse.urlsplit(location).path
+        if path != reverse(name):
+            raise AssertionError('redirected to %s' % (path or 'nothing'))
+
+    def login(self, opener, service, identifier):
+        """
+        Log in with a service as the given user: the site's ``prepare`` view,
+        the user allowing access at the service, then the site's
+        ``authenticate`` view. Returns where the site redirected to.
+
+        """
+        status, location = self.request(opener, '%s-prepare' % service, '/%s/prepare/' % service)
+        if status != 302:
+            raise AssertionError('prepare answered %d' % status)
+        parts = urlparse.urlsplit(location)
+        query = dict(urlparse.parse_qsl(parts.query))
+        query['user_id'] = identifier
+        answer = urllib2.urlopen('%s?%s' % (urlparse.urlunsplit(parts[:3] + ('', '')), urllib.urlencode(query))).read()
+        status, location = self.request(opener, AUTHENTICATE_URLS[service],
+            '/%s/authenticate/?%s' % (service, answer))
+        if status != 302:
+            raise AssertionError('authenticate answered %d' % status)
+        return location
+
+    def new(self):
+        service = random.choice(SERVICES)
+        identifier = self.new_identifiers.next()
+        opener = self.opener()
+        self.expect(self.login(opener, service, identifier), '%s-setup' % service)
+        status, location = self.request(opener, '%s-setup' % service, '/%s/setup/' % service, {
+            'email': 'new%d@example.com' % identifier,
+            'username': 'new%d' % identifier
+        })
+        self.expect(location, 'login')
+
+    def returning(self):
+        service = random.choice(SERVICES)
+        self.expect(self.login(self.opener(), service, existing_identifier(service, self.size)), 'site-home')
+
+    def link(self):
+        service, other = random.sample(SERVICES, 2)
+        opener = self.opener()
+        self.expect(self.login(opener, service, existing_identifier(service, self.size)), 'site-home')
+        self.expect(self.login(opener, other, self.new_identifiers.next()), 'edit-profile')
+
+    def run(self, mix, flows, concurrency):
+        """
+        Run ``flows`` flows, chosen at random with the weights in ``mix``, on
+        ``concurrency`` threads, returning how many seconds it took.
+
+        """
+        choices = []
+        for name, weight in mix:
+            choices.extend([name] * weight)
+        counter = itertools.count()
+
+        def work():
+            while not self.stopping and counter.next() < flows:
+                flow = random.choice(choices)
+                start = timeit.default_timer()
+                try:
+                    getattr(self, flow)()
+                except Exception, e:
+                    self.fail(flow, '%s: %s' % (e.__class__.__name__, e))
+                    continue
+                self.record(self.flows, flow, timeit.default_timer() - start)
+
+        threads = [threading.Thread(target=work) for i in range(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # Joining with a timeout leaves the main thread able to take
+                # a KeyboardInterrupt.
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            # Let the flows in progress finish, but start no more.
+            self.stopping = True
+            for thread in threads:
+                thread.join()
+        return time.time() - start
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--flows', dest='flows', type='int', default=1000,
+        help='The number of flows to run.')
+    parser.add_option('--concurrency', dest='concurrency', type='int', default=20,
+        help='The number of flows to run at once.')
+    parser.add_option('--mix', dest='mix', default='new:1,returning:8,link:1',
+        help='The relative weights of the new, returning and link flows.')
+    parser.add_option('--size', dest='size', type='int', default=10000,
+        help='The number of associations to create before starting.')
+    parser.add_option('--latency', dest='latency', type='float', default=0.1,
+        help='The mean delay, in seconds, of each response from the services.')
+    parser.add_option('--jitter', dest='jitter', type='float', default=0.02,
+        help='The standard deviation of that delay, in seconds.')
+    parser.add_option('--error-rate', dest='error_rate', type='float', default=0,
+        help='The share of requests to the services answered with a 503.')
+    parser.add_option('--drop-rate', dest='drop_rate', type='float', default=0,
+        help='The share of requests to the services whose connection is dropped.')
+    parser.add_option('--rate-limits', dest='rate_limits', action='store_true', default=False,
+        help='Apply the default rate limits to calls to the services.')
+    parser.add_option('--gevent', dest='gevent', action='store_true', default=False,
+        help='Serve the site with gevent, in one thread, rather than a thread per request.')
+    parser.add_option('--output', dest='output', default=None,
+        help='Also write the results to this file as JSON.')
+    options, args = parser.parse_args()
+
+    mix = []
+    for part in options.mix.split(','):
+        name, weight = part.split(':')
+        if name not in ('new', 'returning', 'link'):
+            parser.error('Unknown flow: %s' % name)
+        mix.append((name, int(weight)))
+
+    database = None
+    if 'BENCHMARK_DATABASE_NAME' not in os.environ:
+        # Each request thread has its own connection, so an in-memory
+        # database would not be shared.
+        handle, database = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        os.environ['BENCHMARK_DATABASE_NAME'] = database
+
+    kwargs = {
+        'drop_rate': options.drop_rate,
+        'error_rate': options.error_rate,
+        'jitter': options.jitter,
+        'latency': options.latency
+    }
+    twitter = StubServer(TwitterHandler, **kwargs).start()
+    facebook = StubServer(FacebookHandler, **kwargs).start()
+
+    from django.conf import settings
+    settings.FACEBOOK_GRAPH_URL = facebook.url
+    settings.TWITTER_API_URL = twitter.url
+    if not options.rate_limits:
+        settings.SOCIAL_REGISTRATION_RATE_LIMITS = {}
+    # Keep a connection to each service alive for every flow in flight.
+    settings.SOCIAL_REGISTRATION_HTTP_POOL_SIZE = options.concurrency
+
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.core.management import call_command
+
+    server = None
+    try:
+        call_command('syncdb', interactive=False, verbosity=0)
+        populate(max(2, options.size))
+
+        application = InFlight(WSGIHandler())
+        if options.gevent:
+            from gevent.pywsgi import WSGIServer as GeventWSGIServer
+
+            server = GeventWSGIServer(('127.0.0.1', 0), application, log=None)
+            server.start()
+        else:
+            server = make_server('127.0.0.1', 0, application, ThreadingWSGIServer, QuietWSGIRequestHandler).start()
+
+        driver = Driver('http://127.0.0.1:%d/' % server.server_port, twitter, facebook, max(2, options.size))
+        elapsed = driver.run(mix, options.flows, options.concurrency)
+    finally:
+        # Stopped rather than left to die with the interpreter, which makes
+        # their threads fail noisily.
+        for running in (server, twitter, facebook):
+            if running is not None:
+                running.stop()
+        if database:
+            os.remove(database)
+
+    completed = sum([len(durations) for durations in driver.flows.values()])
+    requests = sum([len(durations) for durations in driver.views.values()])
+    results = {
+        'concurrency': options.concurrency,
+        'elapsed': elapsed,
+        'errors': driver.errors,
+        'flows': dict([(name, summarize(durations)) for name, durations in driver.flows.items()]),
+        'flows_per_second': completed / elapsed,
+        'peak_in_flight': application.peak,
+        'requests_per_second': requests / elapsed,
+        'server': options.gevent and 'gevent' or 'threaded',
+        'views': dict([(name, summarize(durations)) for name, durations in driver.views.items()])
+    }
+
+    print '%d flows completed in %.1fs: %.1f flows/s, %.1f requests/s' % (completed, elapsed,
+        results['flows_per_second'], results['requests_per_second'])
+    print 'At most %d requests in flight at once (%s server).' % (results['peak_in_flight'], results['server'])
+    for kind in ('flows', 'views'):
+        print
+        print '%-28s %7s %9s %9s %9s' % (kind, 'count', 'p50 ms', 'p95 ms', 'p99 ms')
+        for name, summary in sorted(results[kind].items()):
+            print '%-28s %7d %9.1f %9.1f %9.1f' % (name, summary['count'], summary['p50'], summary['p95'], summary['p99'])
+    if driver.errors:
+        print
+        for error, count in sorted(driver.errors.items()):
+            print '%7d  %s' % (count, error)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=4, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
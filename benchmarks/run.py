@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the hot paths of ``social_registration``, run offline
+against an in-memory SQLite database. Calls to Twitter and Facebook are
+answered from the responses recorded in ``fixtures/``.
+
+Every benchmark is run against each of the association table sizes given,
+and the results, in microseconds per call, are written as JSON so that they
+can be kept and compared between releases::
+
+    python benchmarks/run.py --sizes=1000,100000 --output=0.0.1.json
+    python benchmarks/run.py --sizes=1000,100000 --compare=0.0.1.json
+
+Django, django-registration, oauth2 and the Facebook Python SDK must be
+installed, as for the application itself.
+
+"""
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+import urllib
+import urlparse
+
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.dirname(ROOT)]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from data import AUTHENTICATE_URLS, IDENTIFIER_BASE, SERVICES, existing_identifier, missing_identifier, populate
+
+BENCHMARKS = []
+
+
+def benchmark(name, *args):
+    """
+    Registers a benchmark. The decorated function is called with the table
+    size, the ``FixtureTransport`` and ``args``, and returns the callable to
+    time.
+
+    """
+    def decorator(function):
+        BENCHMARKS.append((name, function, args))
+        return function
+    return decorator
+
+
+class FixtureTransport(object):
+    """
+    Stands in for ``social_registration.transport.transport``, answering
+    requests with recorded responses keyed by method and URL (without its
+    query string). ``%(identifier)s`` in a response is replaced with
+    ``identifier``, i.e., the user the next login is for.
+
+    """
+    def __init__(self, *names):
+        self.identifier = None
+        self.responses = {}
+        for name in names:
+            f = open(os.path.join(ROOT, 'fixtures', '%s.json' % name))
+            try:
+                self.responses.update(json.load(f))
+            finally:
+                f.close()
+
+    def request(self, url, method='GET', body=None, headers=None, service=None, endpoint=None, essential=True,
+            idempotent=None):
+        response = self.responses['%s %s' % (method, url.split('?')[0])]
+        content = response['body'] % {'identifier': self.identifier}
+        return response['status'], dict(response['headers']), content.encode('utf-8')
+
+
+def measure(function, number, repeat):
+    """
+    Times ``repeat`` rounds of ``number`` calls, returning the fastest,
+    median and mean time per call in microseconds.
+
+    """
+    timings = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        for j in range(number):
+            function()
+        timings.append((timeit.default_timer() - start) / number * 1e6)
+    timings.sort()
+    return {
+        'mean': sum(timings) / len(timings),
+        'median': timings[len(timings) // 2],
+        'min': timings[0]
+    }
+
+
+@benchmark('get_backend.facebook', 'facebook')
+@benchmark('get_backend.twitter', 'twitter')
+def bench_get_backend(size, fixtures, service):
+    from social_registration.backends import get_backend
+
+    path = 'social_registration.backends.%s.AccountBackend' % service
+    return lambda: get_backend(path)
+
+
+@benchmark('authenticate.facebook.hit', 'facebook', True)
+@benchmark('authenticate.facebook.miss', 'facebook', False)
+@benchmark('authenticate.twitter.hit', 'twitter', True)
+@benchmark('authenticate.twitter.miss', 'twitter', False)
+def bench_authenticate(size, fixtures, service, hit):
+    from django.utils.importlib import import_module
+
+    backend = import_module('social_registration.backends.%s' % service).AuthenticationBackend()
+    if hit:
+        return lambda: backend.authenticate(service=service, identifier=existing_identifier(service, size))
+    return lambda: backend.authenticate(service=service, identifier=missing_identifier())
+
+
+def facebook_cookie(identifier):
+    """
+    Returns an ``fbs_`` cookie for the given user, signed as Facebook would.
+
+    """
+    from django.conf import settings
+
+    values = {
+        'access_token': 'token%d' % identifier,
+        'expires': '0',
+        'secret': 'secret',
+        'session_key': 'session%d' % identifier,
+        'uid': str(identifier)
+    }
+    payload = ''.join(['%s=%s' % (key, values[key]) for key in sorted(values)])
+    values['sig'] = hashlib.md5(payload + settings.FACEBOOK_SECRET_KEY).hexdigest()
+    return urllib.urlencode(values)
+
+
+@benchmark('middleware.anonymous.forced', False, True)
+@benchmark('middleware.anonymous.lazy', False, False)
+@benchmark('middleware.cookie.forced', True, True)
+@benchmark('middleware.cookie.lazy', True, False)
+def bench_middleware(size, fixtures, cookie, forced):
+    from django.conf import settings
+    from django.test.client import RequestFactory
+    from social_registration.backends.facebook.middleware import FacebookMiddleware
+
+    middleware = FacebookMiddleware()
+    factory = RequestFactory()
+    if cookie:
+        factory.cookies['fbs_%s' % settings.FACEBOOK_API_KEY] = facebook_cookie(existing_identifier('facebook', size))
+
+    def run():
+        request = factory.get('/')
+        middleware.process_request(request)
+        # Most requests never read ``request.facebook``, and should not pay
+        # for the cookie to be parsed.
+        if forced:
+            return request.facebook.identifier
+    return run
+
+
+@benchmark('clean_username.free', False)
+@benchmark('clean_username.taken', True)
+def bench_clean_username(size, fixtures, taken):
+    from social_registration.forms import UserForm
+
+    form_class = UserForm.for_profile('twitter:%d' % IDENTIFIER_BASE, ['benchmark', 'Benchmark User'])
+
+    def run():
+        username = '%s%d' % (taken and 'user' or 'free', random.randrange(size))
+        return form_class({'email': 'benchmark@example.com', 'username': username}).is_valid()
+    return run
+
+
+@benchmark('registration_state')
+def bench_registration_state(size, fixtures):
+    from django.contrib.sessions.backends.db import SessionStore
+    from social_registration.state import RegistrationState
+
+    session = SessionStore()
+    state = RegistrationState('twitter', '120889797', '120889797-H5zNnM3qE0iFoTTpNEHIz3noL9FKzXiOxwtnyVOD',
+        'IcJXPiJh8be3BjDWW50uCY31chyhsMHEhqJVsphC3M', 'heyismysiteup')
+
+    def run():
+        data = session.decode(session.encode({RegistrationState.session_key: state.dumps()}))
+        return RegistrationState.loads(data[RegistrationState.session_key])
+    return run
+
+
+@benchmark('flow.facebook.create', 'facebook', False)
+@benchmark('flow.facebook.grant', 'facebook', True)
+@benchmark('flow.twitter.create', 'twitter', False)
+@benchmark('flow.twitter.grant', 'twitter', True)
+def bench_flow(size, fixtures, service, returning):
+    """
+    A login through the real URLconf: the ``prepare`` view, then the
+    ``authenticate`` view as called back by the service, ending in either
+    ``grant_user()`` for a returning user or ``create_user()`` for a new one.
+
+    """
+    from django.core.urlresolvers import reverse
+    from django.test.client import Client
+
+    expected = reverse(returning and 'site-home' or '%s-setup' % service)
+
+    def run():
+        if returning:
+            fixtures.identifier = existing_identifier(service, size)
+        else:
+            fixtures.identifier = missing_identifier()
+        client = Client()
+        response = client.get(reverse('%s-prepare' % service))
+        # Twitter's request token is handed back to the callback.
+        query = dict(urlparse.parse_qsl(urlparse.urlsplit(response['Location']).query))
+        response = client.get(reverse(AUTHENTICATE_URLS[service]), {
+            'code': 'benchmarks',
+            'oauth_token': query.get('oauth_token', ''),
+            'oauth_verifier': 'benchmarks'
+        })
+        if response.status_code != 302 or urlparse.urlsplit(response['Location']).path != expected:
+            raise AssertionError('The %s login for %s ended with a %d to %r.' % (service,
+                fixtures.identifier, response.status_code, response.get('Location')))
+    return run
+
+
+def environment():
+    import django
+    import social_registration
+
+    return {
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'social_registration': social_registration.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', dest='sizes', default='1000,10000,100000',
+        help='Comma-separated association table sizes to run the benchmarks against.')
+    parser.add_option('--number', dest='number', type='int', default=100,
+        help='The number of calls in each timed round.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+        help='The number of timed rounds.')
+    parser.add_option('--only', dest='only', default='',
+        help='Only run the benchmarks whose names start with this.')
+    parser.add_option('--output', dest='output', default=None,
+        help='Write the results to this file rather than standard output.')
+    parser.add_option('--compare', dest='compare', default=None,
+        help='The results of an earlier run to report the change against.')
+    options, args = parser.parse_args()
+
+    from django.core.management import call_command
+    from social_registration.transport import transport
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    fixtures = FixtureTransport('facebook', 'twitter')
+    transport.request = fixtures.request
+
+    baseline = {}
+    if options.compare:
+        for result in json.load(open(options.compare))['results']:
+            baseline[(result['name'], result['size'])] = result['median']
+
+    results = []
+    for size in sorted(set([max(2, int(size)) for size in options.sizes.split(',')])):
+        populate(size)
+        for name, function, args in sorted(BENCHMARKS):
+            if not name.startswith(options.only):
+                continue
+            run = function(size, fixtures, *args)
+            run()
+            result = measure(run, options.number, options.repeat)
+            result.update(name=name, size=size)
+            line = '%-28s %9d %12.1fus' % (name, size, result['median'])
+            if (name, size) in baseline:
+                result['baseline'] = baseline[(name, size)]
+                result['change'] = result['median'] / result['baseline'] - 1
+                line = '%s %+7.1f%%' % (line, result['change'] * 100)
+            sys.stderr.write('%s\n' % line)
+            results.append(result)
+
+    output = json.dumps({
+        'environment': environment(),
+        'number': options.number,
+        'repeat': options.repeat,
+        'results': results
+    }, indent=4, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output)
+        finally:
+            f.close()
+    else:
+        sys.stdout.write('%s\n' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Settings for running the benchmarks offline, by default against an in-memory
+SQLite database. Another database can be given with the
+``BENCHMARK_DATABASE_ENGINE`` and ``BENCHMARK_DATABASE_NAME`` environment
+variables (plus ``_USER``, ``_PASSWORD`` and ``_HOST``).
+
+"""
+import os
+
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': os.environ.get('BENCHMARK_DATABASE_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('BENCHMARK_DATABASE_NAME', ':memory:'),
+        'USER': os.environ.get('BENCHMARK_DATABASE_USER', ''),
+        'PASSWORD': os.environ.get('BENCHMARK_DATABASE_PASSWORD', ''),
+        'HOST': os.environ.get('BENCHMARK_DATABASE_HOST', '')
+    }
+}
+
+if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    # Wait for the writes of concurrent requests rather than fail.
+    DATABASES['default']['OPTIONS'] = {'timeout': 30}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+}
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.messages',
+    'django.contrib.sessions',
+    'registration',
+    'social_registration',
+)
+
+MIDDLEWARE_CLASSES = (
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'social_registration.backends.facebook.middleware.FacebookMiddleware',
+)
+
+AUTHENTICATION_BACKENDS = (
+    'django.contrib.auth.backends.ModelBackend',
+    'social_registration.backends.facebook.AuthenticationBackend',
+    'social_registration.backends.twitter.AuthenticationBackend',
+)
+
+ROOT_URLCONF = 'urls'
+SECRET_KEY = 'benchmarks'
+SITE_ID = 1
+
+LOGIN_URL = '/login/'
+LOGIN_REDIRECT_URL = '/'
+PERSISTENT_SESSION_KEY = 'persistent'
+
+FACEBOOK_API_KEY = 'benchmarks'
+FACEBOOK_APPLICATION_ID = '115263198502235'
+FACEBOOK_SECRET_KEY = 'benchmarks'
+
+TWITTER_KEY = 'benchmarks'
+TWITTER_SECRET = 'benchmarks'
+
+# Queue deferred work rather than run it in threads, which would not see the
+# in-memory database.
+SOCIAL_REGISTRATION_TASK_EXECUTOR = 'social_registration.tasks.DatabaseExecutor'
+
+# Set the environment variable to benchmark with the association cache on.
+SOCIAL_REGISTRATION_CACHE = bool(os.environ.get('SOCIAL_REGISTRATION_CACHE'))
+
+# Set to "raise" to fail the benchmarks when a flow goes over its query
+# budget, or "warn" to log it.
+SOCIAL_REGISTRATION_QUERY_BUDGET_MODE = os.environ.get('SOCIAL_REGISTRATION_QUERY_BUDGET_MODE')
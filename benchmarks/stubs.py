@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Local stand-ins for the parts of Twitter and Facebook used by the account
+backends, for load testing without touching the real services:
+
+    *   Twitter's OAuth 1.0a ``request_token``, ``authenticate`` and
+        ``access_token`` endpoints, plus ``users/show`` and ``users/lookup``.
+    *   Facebook's OAuth ``authorize`` and ``access_token`` endpoints (which
+        also renews tokens), ``/me``, ``/me/picture`` and Graph API batch
+        requests.
+
+Signatures and secrets are not checked. The user a login is for is chosen by
+passing ``user_id`` to the ``authenticate`` (Twitter) or ``authorize``
+(Facebook) endpoint, which answer with the token or code to hand to the
+site's callback rather than redirecting.
+
+Every response can be delayed and a share of them replaced with errors. Point
+the ``TWITTER_API_URL`` and ``FACEBOOK_GRAPH_URL`` settings at the servers to
+use them, e.g.::
+
+    python benchmarks/stubs.py --twitter-port=8001 --facebook-port=8002 --latency=0.15
+
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import socket
+import threading
+import time
+import urlparse
+import uuid
+
+from optparse import OptionParser
+
+
+class StoppableMixIn(SocketServer.ThreadingMixIn):
+    """
+    Serves each connection in its own thread, as ``ThreadingMixIn`` does,
+    remembering them so that ``stop()`` can close the connections still
+    kept alive and wait for every thread to finish before the process
+    exits.
+
+    """
+    def start(self):
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.connections_lock.acquire()
+        try:
+            self.connections = [(r, t) for r, t in self.connections if t.is_alive()]
+            self.connections.append((request, thread))
+        finally:
+            self.connections_lock.release()
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        self.connections_lock.acquire()
+        try:
+            connections, self.connections = self.connections, []
+        finally:
+            self.connections_lock.release()
+        for request, thread in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+
+class StubServer(StoppableMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server for one of the stub services. Each response is
+    delayed by ``latency`` seconds, give or take ``jitter``; ``error_rate``
+    of them are answered with a 503, and ``drop_rate`` of the connections
+    are closed without any answer.
+
+    Tokens and codes handed out are remembered with the user they were
+    granted to.
+
+    """
+    def __init__(self, handler_class, port=0, latency=0, jitter=0, error_rate=0, drop_rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), handler_class)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.grants = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_port
+
+    def grant(self, identifier, value=None):
+        """
+        Grant a token or code, new unless ``value`` is given, to the given
+        user and return it.
+
+        """
+        value = value or uuid.uuid4().hex
+        self.lock.acquire()
+        try:
+            self.grants[value] = identifier
+        finally:
+            self.lock.release()
+        return value
+
+    def identify(self, value):
+        """
+        Return the user a token or code was granted to, or ``None``.
+
+        """
+        self.lock.acquire()
+        try:
+            return self.grants.get(value)
+        finally:
+            self.lock.release()
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Dispatches requests to the methods named in ``routes`` by method and
+    path. A route returns a status, a content type and a body.
+
+    """
+    # Connections are kept alive, as by the real services, so that the
+    # transport's pooling is exercised.
+    protocol_version = 'HTTP/1.1'
+    routes = {}
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        parts = urlparse.urlsplit(self.path)
+        self.parameters = dict(urlparse.parse_qsl(parts.query))
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+            self.parameters.update(urlparse.parse_qsl(body))
+
+        server = self.server
+        if server.latency:
+            time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if random.random() < server.drop_rate:
+            self.close_connection = 1
+            return
+        if random.random() < server.error_rate:
+            return self.respond(503, 'text/plain', 'Service Unavailable')
+
+        route = self.routes.get((method, parts.path))
+        if route is None:
+            return self.respond(404, 'text/plain', 'Not Found')
+        self.respond(*getattr(self, route)())
+
+    def respond(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def twitter_user(identifier):
+    return {
+        'id': int(identifier),
+        'id_str': str(identifier),
+        'name': 'User %s' % identifier,
+        'profile_image_url': 'http://a0.twimg.com/profile_images/%s/avatar_normal.png' % identifier,
+        'screen_name': 'user_%s' % identifier
+    }
+
+
+class TwitterHandler(StubHandler):
+    routes = {
+        ('GET', '/1/users/lookup.json'): 'users_lookup',
+        ('GET', '/1/users/show.json'): 'users_show',
+        ('GET', '/oauth/access_token'): 'access_token',
+        ('GET', '/oauth/authenticate'): 'authenticate',
+        ('GET', '/oauth/request_token'): 'request_token',
+    }
+
+    def request_token(self):
+        return (200, 'text/html', 'oauth_token=%s&oauth_token_secret=%s&oauth_callback_confirmed=true' % (
+            uuid.uuid4().hex, uuid.uuid4().hex))
+
+    def authenticate(self):
+        # Stands in for the user signing in to Twitter and allowing access.
+        token = self.parameters['oauth_token']
+        self.server.grant(self.parameters['user_id'], token)
+        return (200, 'text/html', 'oauth_token=%s&oauth_verifier=%s' % (token, uuid.uuid4().hex))
+
+    def access_token(self):
+        identifier = self.server.identify(self.parameters.get('oauth_token'))
+        if identifier is None:
+            return (401, 'text/html', 'Invalid / expired Token')
+        return (200, 'text/html', 'oauth_token=%s-%s&oauth_token_secret=%s&user_id=%s&screen_name=user_%s' % (
+            identifier, uuid.uuid4().hex, uuid.uuid4().hex, identifier, identifier))
+
+    def users_show(self):
+        return (200, 'application/json', json.dumps(twitter_user(self.parameters['user_id'])))
+
+    def users_lookup(self):
+        users = [twitter_user(identifier) for identifier in self.parameters['user_id'].split(',')]
+        return (200, 'application/json', json.dumps(users))
+
+
+def facebook_user(identifier):
+    return {
+        'first_name': 'User',
+        'id': str(identifier),
+        'last_name': str(identifier),
+        'link': 'http://www.facebook.com/profile.php?id=%s' % identifier,
+        'name': 'User %s' % identifier
+    }
+
+
+def facebook_picture(identifier):
+    return {'data': {'is_silhouette': False, 'url': 'https://fbcdn-profile-a.akamaihd.net/%s_q.jpg' % identifier}}
+
+
+class FacebookHandler(StubHandler):
+    routes = {
+        ('GET', '/me'): 'me',
+        ('GET', '/me/picture'): 'me_picture',
+        ('GET', '/oauth/access_token'): 'access_token',
+        ('GET', '/oauth/authorize'): 'authorize',
+        ('POST', '/'): 'batch',
+    }
+
+    def authorize(self):
+        # Stands in for the user logging in to Facebook and allowing access.
+        return (200, 'text/plain', 'code=%s' % self.server.grant(self.parameters['user_id']))
+
+    def access_token(self):
+        if self.parameters.get('grant_type') == 'fb_exchange_token':
+            # Renews a token granted earlier for a new one.
+            identifier = self.server.identify(self.parameters.get('fb_exchange_token'))
+            error = {'type': 'OAuthException', 'code': 190, 'message': 'Error validating access token.'}
+        else:
+            identifier = self.server.identify(self.parameters.get('code'))
+            error = {'type': 'OAuthException', 'code': 100, 'message': 'Invalid verification code format.'}
+        if identifier is None:
+            return (400, 'text/javascript', json.dumps({'error': error}))
+        return (200, 'text/plain', 'access_token=%s&expires=5183999' % self.server.grant(identifier))
+
+    def resolve(self, path):
+        """
+        Return the status and body of a Graph API object, as a dictionary,
+        for the current access token.
+
+        """
+        parts = urlparse.urlsplit(path)
+        path = parts.path.strip('/').split('/')
+        identifier = path[0]
+        if identifier == 'me':
+            identifier = self.server.identify(self.parameters.get('access_token'))
+            if identifier is None:
+                return 400, {'error': {'type': 'OAuthException', 'message': 'Invalid OAuth access token.'}}
+        if path[1:] == ['picture']:
+            return 200, facebook_picture(identifier)
+        return 200, facebook_user(identifier)
+
+    def me(self):
+        status, data = self.resolve('me')
+        return (status, 'text/javascript', json.dumps(data))
+
+    def me_picture(self):
+        status, data = self.resolve('me/picture')
+        return (status, 'text/javascript', json.dumps(data))
+
+    def batch(self):
+        responses = []
+        for request in json.loads(self.parameters['batch']):
+            status, data = self.resolve(request['relative_url'])
+            responses.append({
+                'body': json.dumps(data),
+                'code': status,
+                'headers': [{'name': 'Content-Type', 'value': 'text/javascript; charset=UTF-8'}]
+            })
+        return (200, 'text/javascript', json.dumps(responses))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--twitter-port', dest='twitter_port', type='int', default=8001)
+    parser.add_option('--facebook-port', dest='facebook_port', type='int', default=8002)
+    parser.add_option('--latency', dest='latency', type='float', default=0,
+        help='The mean delay, in seconds, before each response.')
+    parser.add_option('--jitter', dest='jitter', type='float', default=0,
+        help='The standard deviation of the delay, in seconds.')
+    parser.add_option('--error-rate', dest='error_rate', type='float', default=0,
+        help='The share of requests answered with a 503.')
+    parser.add_option('--drop-rate', dest='drop_rate', type='float', default=0,
+        help='The share of requests whose connection is closed without an answer.')
+    options, args = parser.parse_args()
+
+    kwargs = {
+        'drop_rate': options.drop_rate,
+        'error_rate': options.error_rate,
+        'jitter': options.jitter,
+        'latency': options.latency
+    }
+    twitter = StubServer(TwitterHandler, options.twitter_port, **kwargs).start()
+    facebook = StubServer(FacebookHandler, options.facebook_port, **kwargs).start()
+    print 'TWITTER_API_URL = %r' % twitter.url
+    print 'FACEBOOK_GRAPH_URL = %r' % facebook.url
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    twitter.stop()
+    facebook.stop()
+
+
+if __name__ == '__main__':
+    main()
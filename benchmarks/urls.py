@@ -0,0 +1,24 @@
+from django.conf.urls.defaults import *
+from django.http import HttpResponse
+
+
+def home(request):
+    return HttpResponse('')
+
+
+urlpatterns = patterns('',
+
+    url(r'^$',
+        view    = home,
+        name    = 'site-home'
+    ),
+    url(r'^profile/$',
+        view    = home,
+        name    = 'edit-profile'
+    ),
+    (r'^', include('social_registration.backends.default.urls')),
+    (r'^', include('social_registration.backends.facebook.urls')),
+    (r'^', include('social_registration.backends.twitter.urls')),
+
+)
+
@@ -1,11 +1,144 @@
+import re
+
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
 from django.db.models import get_model
+from django.db.models.query import QuerySet
+
+from social_registration.cache import association_cache
+
+
+# Below this many rows counts are exact; above it the query planner's
+# estimate is used instead.
+ESTIMATE_THRESHOLD = 10000
+
+# The number of associations whose cache keys an action reads at a time.
+CACHE_BATCH_SIZE = 1000
+
+
+def estimate_count(queryset):
+    """
+    Return PostgreSQL's estimate of the number of rows a queryset matches,
+    read from the plan of the query without running it, or ``None`` on other
+    databases.
+
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN %s' % sql, params)
+    match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+    return match and int(match.group(1))
+
+
+class EstimatedCountQuerySet(QuerySet):
+    """
+    A queryset whose ``count()`` is estimated once it reaches
+    ``ESTIMATE_THRESHOLD``, which spares the changelist an exact
+    ``COUNT(*)`` of the whole table for its "(n total)" link.
+
+    """
+    def count(self):
+        if self._result_cache is None:
+            estimate = estimate_count(self)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return super(EstimatedCountQuerySet, self).count()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that counts exactly up to ``ESTIMATE_THRESHOLD`` rows and
+    estimates beyond that, so that paging through millions of rows does not
+    count them all first. The last pages of an estimate may be empty.
+
+    """
+    def _get_count(self):
+        if self._count is None:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                self._count = estimate
+            else:
+                self._count = self.object_list.count()
+        return self._count
+    count = property(_get_count)
+
+
+class AssociationChangeList(ChangeList):
+    """
+    Searches for a number by identifier, with an exact lookup the identifier
+    index can serve, and for anything else by the start of the username.
+
+    """
+    def get_query_set(self, request):
+        query = self.query
+        # Identifiers are positive integers of at most ten digits.
+        if not query.strip().isdigit() or len(query.strip()) > 10:
+            return super(AssociationChangeList, self).get_query_set(request)
+        self.query = ''
+        try:
+            queryset = super(AssociationChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        return queryset.filter(identifier=int(query.strip()))
 
 
 class AssociationAdmin(admin.ModelAdmin):
+    actions = ['deactivate', 'reactivate']
     list_display = ['user', 'service', 'identifier', 'avatar', 'is_active']
+    list_filter = ['service', 'is_active']
+    list_select_related = True
+    paginator = EstimatedCountPaginator
+    raw_id_fields = ['user']
+    search_fields = ['^user__username']
 
+    def queryset(self, request):
+        return super(AssociationAdmin, self).queryset(request)._clone(klass=EstimatedCountQuerySet)
 
-admin.site.register(get_model('social_registration', 'association'), AssociationAdmin)
+    def get_changelist(self, request, **kwargs):
+        return AssociationChangeList
 
+    def set_active(self, request, queryset, is_active):
+        """
+        Sets ``is_active`` on the selected associations with a single
+        ``UPDATE``. That bypasses the signal handlers that keep the
+        association cache fresh, so the cached users of those deactivated
+        are dropped here.
 
+        Only active associations are ever cached, so reactivating drops
+        nothing. Before deactivating, the keys of the selected associations
+        that are active are read a batch at a time, since the selection may
+        no longer match once updated (e.g., when filtered on ``is_active``).
+
+        """
+        keys = []
+        if association_cache.enabled and not is_active:
+            active = queryset.filter(is_active=True).order_by('pk')
+            last_pk = 0
+            while True:
+                rows = list(active.filter(pk__gt=last_pk).values_list('pk', 'service', 'identifier')[:CACHE_BATCH_SIZE])
+                if not rows:
+                    break
+                keys.extend([(service, identifier) for pk, service, identifier in rows])
+                last_pk = rows[-1][0]
+        count = queryset.update(is_active=is_active)
+        for service, identifier in keys:
+            association_cache.delete(service, identifier)
+        return count
+
+    def deactivate(self, request, queryset):
+        count = self.set_active(request, queryset, False)
+        self.message_user(request, '%d associations were deactivated.' % count)
+    deactivate.short_description = 'Deactivate the selected associations'
+
+    def reactivate(self, request, queryset):
+        count = self.set_active(request, queryset, True)
+        self.message_user(request, '%d associations were reactivated.' % count)
+    reactivate.short_description = 'Reactivate the selected associations'
+
+
+admin.site.register(get_model('social_registration', 'association'), AssociationAdmin)
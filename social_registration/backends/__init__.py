@@ -1,27 +1,78 @@
+import threading
+
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.importlib import import_module
 
 
-def get_backend(path):
+# A process-wide registry of resolved backend classes, keyed by their dotted
+# import path. Each class is imported, validated and configured exactly once.
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_backend_class(path):
     """
-    Return an instance of a registration backend, given the dotted Python
-    import path (as a string) to the backend class.
+    Return the registration backend class located at the given dotted Python
+    import path (as a string), resolving and configuring it on first use.
+
+    Resolved classes are kept in a process-wide registry so that subsequent
+    calls are a single dictionary lookup. When a class is first resolved its
+    ``configure()`` classmethod, if any, is invoked so that settings can be
+    validated and shared, immutable configuration built once.
 
     If the backend cannot be located (e.g., because no such module exists, or
     because the module does not contain a class of the appropriate name),
     ``django.core.exceptions.ImproperlyConfigured`` is raised.
 
     """
-    i = path.rfind('.')
-    module, attr = path[:i], path[i+1:]
     try:
-        mod = import_module(module)
-    except ImportError, e:
-        raise ImproperlyConfigured('Error loading account backend %s: "%s"' % (module, e))
+        return _registry[path]
+    except KeyError:
+        pass
+    _registry_lock.acquire()
     try:
-        backend_class = getattr(mod, attr)
-    except AttributeError:
-        raise ImproperlyConfigured('Module "%s" does not define a account backend named "%s"' % (module, attr))
-    return backend_class()
+        if path not in _registry:
+            i = path.rfind('.')
+            module, attr = path[:i], path[i+1:]
+            try:
+                mod = import_module(module)
+            except ImportError, e:
+                raise ImproperlyConfigured('Error loading account backend %s: "%s"' % (module, e))
+            try:
+                backend_class = getattr(mod, attr)
+            except AttributeError:
+                raise ImproperlyConfigured('Module "%s" does not define a account backend named "%s"' % (module, attr))
+            if hasattr(backend_class, 'configure'):
+                backend_class.configure()
+            _registry[path] = backend_class
+        return _registry[path]
+    finally:
+        _registry_lock.release()
+
+
+def get_backend(path):
+    """
+    Return an instance of a registration backend, given the dotted Python
+    import path (as a string) to the backend class.
+
+    The class itself is resolved through ``get_backend_class()``, so only the
+    first call for a given path pays for the import; the instance returned
+    holds nothing but cheap, per-request state.
+
+    """
+    return get_backend_class(path)()
+
 
+def load_backends(paths=None):
+    """
+    Resolve and configure every backend listed in ``paths`` or, if omitted,
+    the ``SOCIAL_REGISTRATION_BACKENDS`` setting. Calling this from a URLconf
+    or WSGI script makes a misconfigured backend fail when the process starts
+    rather than on the first user to log in.
+
+    """
+    if paths is None:
+        paths = getattr(settings, 'SOCIAL_REGISTRATION_BACKENDS', ())
+    return [get_backend_class(path) for path in paths]
 
@@ -1,11 +1,76 @@
+import copy
+
+from django.contrib.auth.backends import ModelBackend
+
+from social_registration.cache import association_cache
+from social_registration.models import Association
+
+
+class AuthenticationBackend(ModelBackend):
+    """
+    A base authentication backend that, when subclassed with a ``service``,
+    resolves a service's identifier to the ``User`` it is associated with.
+
+    Credentials carry the service they belong to, so when several of these
+    backends are listed in ``AUTHENTICATION_BACKENDS`` only the one matching
+    the service touches the database; the rest return ``None`` immediately.
+
+    Returning users are served from ``association_cache`` when the
+    ``SOCIAL_REGISTRATION_CACHE`` setting is enabled. Either way the user
+    carries the primary key of the ``Association`` found as its
+    ``social_association_id`` attribute, so that the account backend need not
+    look it up again.
+
+    """
+    service = None
+
+    def authenticate(self, service=None, identifier=None):
+        if service is None or service != self.service:
+            return None
+        # The cache may hold on to the instance it was given, and the caller
+        # will change the one it gets, e.g. its ``last_login``, so each side
+        # has a copy of its own.
+        user = association_cache.get(service, identifier)
+        if user is not None:
+            return copy.copy(user)
+        try:
+            association = Association.objects.select_related('user').get(
+                identifier=identifier,
+                is_active=True,
+                service=service
+            )
+        except Association.DoesNotExist:
+            return None
+        user = association.user
+        user.social_association_id = association.pk
+        association_cache.set(service, identifier, copy.copy(user))
+        return user
+
+
 class DefaultBackend(object):
     """
     A base backend that, when subclassed, allows various authentication
     workflows to be created.
 
     """
+    service = None
+
     def __init__(self):
-        self.service = None
+        pass
+
+    @classmethod
+    def configure(cls):
+        """
+        Invoked once per process, when the backend class is first resolved by
+        ``get_backend_class()``. Settings should be validated here and any
+        configuration that is shared between requests built and stored on the
+        class, leaving ``__init__()`` to set up per-request state only.
+
+        A misconfiguration should raise
+        ``django.core.exceptions.ImproperlyConfigured``.
+
+        """
+        pass
 
     def prepare(self, request, **kwargs):
         """
@@ -74,6 +139,19 @@ class DefaultBackend(object):
         """
         raise NotImplementedError('This method must be set by a subclass.')
 
+    def get_association_id(self, user, identifier):
+        """
+        Return the primary key of the user's ``Association`` with the given
+        identifier. A user from ``AuthenticationBackend`` carries it already;
+        it is only looked up for a user that came from elsewhere.
+
+        """
+        association_id = getattr(user, 'social_association_id', None)
+        if association_id is None:
+            association_id = Association.objects.filter(identifier=identifier,
+                service=self.service).values_list('pk', flat=True).get()
+        return association_id
+
     def post_authentication_redirect(self, request):
         """
         Return the name of the URL to redirect to after a successful login.
@@ -81,6 +159,14 @@ class DefaultBackend(object):
         """
         return ('site-home', (), {})
 
+    def provider_error_redirect(self, request):
+        """
+        Return the name of the URL to redirect to when the external service
+        could not be reached or refused the request.
+
+        """
+        return ('login', (), {})
+
     def post_deauthentication_redirect(self, request):
         """
         Return the name of the URL to redirect to after a successful logout.
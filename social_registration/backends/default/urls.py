@@ -37,6 +37,10 @@ urlpatterns = patterns('',
     url(r'^password/reset/done/$',
         view    = 'django.contrib.auth.views.password_reset_done',
         name    = 'password-reset-done'
+    ),
+    url(r'^username/available/$',
+        view    = 'social_registration.views.username_available',
+        name    = 'username-available'
     )
 
 )
@@ -1,3 +1,4 @@
+import datetime
 import json
 import urllib
 import urlparse
@@ -5,24 +6,53 @@ import urlparse
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
-from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
-
-from registration import signals
-from registration.forms import UserForm
-from social_registration.backends.default import AccountBackend as DefaultBackend
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from social_registration.backends import get_backend
+from social_registration.backends.default import AuthenticationBackend as BaseAuthenticationBackend
+from social_registration.backends.default import DefaultBackend
+from social_registration.exceptions import InvalidToken, ProviderError, RateLimited
+from social_registration.forms import UserForm
+from social_registration.instrumentation import timed
 from social_registration.models import Association
+from social_registration.profiles import profile_cache
+from social_registration.queries import query_budget
+from social_registration.state import RegistrationState
+from social_registration.tasks import notify_user_registered
+from social_registration.transport import transport
 
 
-class AuthenticationBackend(ModelBackend):
-    def authenticate(self, identifier):
-        try:
-            association = Association.objects.get(identifier=identifier, service='facebook')
-            return association.user
-        except (Association.DoesNotExist, User.DoesNotExist):
-            return None
+# The OAuthException code for an access token that has expired or been
+# revoked, and those for the application being rate limited.
+INVALID_TOKEN_CODE = 190
+RATE_LIMIT_CODES = (4, 17, 32, 613)
+
+
+class AuthenticationBackend(BaseAuthenticationBackend):
+    service = 'facebook'
+
+
+class Profile(object):
+    """
+    A Facebook user's profile bundled with the URL of their picture. Both are
+    fetched together once per authentication and reused by every later step
+    of the workflow instead of being requested again.
+
+    """
+    def __init__(self, data, avatar=''):
+        self.data = data
+        self.avatar = avatar
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
 
 
 class AccountBackend(DefaultBackend):
@@ -31,21 +61,176 @@ class AccountBackend(DefaultBackend):
     the Facebook Platform (OAuth 2.0).
 
     """
-    def __init__(self, *args, **kwargs):
-        # URLs
-        self.access_token_url = 'https://graph.facebook.com/oauth/access_token'
-        self.authorize_url = 'https://graph.facebook.com/oauth/authorize'
-        self.graph_url = 'https://graph.facebook.com/me'
+    # URLs
+    access_token_url = 'https://graph.facebook.com/oauth/access_token'
+    authorize_url = 'https://graph.facebook.com/oauth/authorize'
+    graph_url = 'https://graph.facebook.com/'
+
+    # Facebook accepts 50 requests per batch, two per user.
+    batch_size = 25
+
+    # Shared Configuration
+    default_parameters = None
+    service = 'facebook'
 
+    def __init__(self, *args, **kwargs):
         # Instance Variables
         self.access_token = None
-        self.parameters = {
+        self.expires_at = None
+        self.parameters = dict(self.default_parameters)
+        self.profile = None
+        super(AccountBackend, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def configure(cls):
+        """
+        Validates the Facebook Platform settings and builds the query
+        parameters shared by every request.
+
+        If the ``FACEBOOK_GRAPH_URL`` setting is given, every call is made to
+        that URL instead of graph.facebook.com (e.g., to a stand-in for load
+        testing).
+
+        """
+        for name in ('FACEBOOK_APPLICATION_ID', 'FACEBOOK_SECRET_KEY'):
+            if not getattr(settings, name, None):
+                raise ImproperlyConfigured('The Facebook account backend requires the %s setting.' % name)
+        graph_url = getattr(settings, 'FACEBOOK_GRAPH_URL', None)
+        if graph_url:
+            cls.access_token_url = urlparse.urljoin(graph_url, 'oauth/access_token')
+            cls.authorize_url = urlparse.urljoin(graph_url, 'oauth/authorize')
+            cls.graph_url = graph_url
+        cls.default_parameters = {
             'client_id': settings.FACEBOOK_APPLICATION_ID,
             'scope': 'email,user_birthday,publish_stream'
         }
-        self.profile = None
-        self.service = 'facebook'
-        super(AccountBackend, self).__init__(*args, **kwargs)
+        if getattr(settings, 'SOCIAL_REGISTRATION_HTTP_PREWARM', False):
+            transport.warm([cls.access_token_url])
+
+    def parse_access_token(self, content):
+        """
+        Returns the access token in a response from the ``access_token``
+        endpoint and when it expires, or ``None`` if Facebook did not say.
+
+        Expiry is measured with ``django.utils.timezone.now()``, the clock
+        Django itself uses for ``DateTimeField`` values such as
+        ``User.last_login``, so it is timezone-aware when ``USE_TZ`` is on.
+
+        """
+        response = urlparse.parse_qs(content)
+        expires_at = None
+        if response.get('expires'):
+            expires_at = timezone.now() + datetime.timedelta(seconds=int(response['expires'][-1]))
+        return response['access_token'][-1], expires_at
+
+    def exchange_token(self, access_token):
+        """
+        Exchanges an access token that has yet to expire for a new long-lived
+        one, returning it and when it expires. Raises ``InvalidToken`` only
+        if Facebook says the token itself is no good (it has expired, or the
+        user has removed the application or changed their password), after
+        which only the user logging in again will give us a new one. Being
+        rate limited raises ``RateLimited``, and any other error
+        ``ProviderError``, so that the token is tried again later.
+
+        Exchanges are not essential calls, so they are refused rather than
+        delayed when the rate limit is reached.
+
+        """
+        parameters = {
+            'client_id': settings.FACEBOOK_APPLICATION_ID,
+            'client_secret': settings.FACEBOOK_SECRET_KEY,
+            'fb_exchange_token': access_token,
+            'grant_type': 'fb_exchange_token'
+        }
+        status, headers, content = transport.request('%s?%s' % (self.access_token_url, urllib.urlencode(parameters)),
+            service=self.service, endpoint='oauth', essential=False)
+        if status == 200:
+            return self.parse_access_token(content)
+        try:
+            error = json.loads(content).get('error', {})
+        except (AttributeError, ValueError):
+            error = {}
+        if error.get('code') == INVALID_TOKEN_CODE:
+            raise InvalidToken('Facebook refused the access token: %s' % error.get('message'))
+        if error.get('code') in RATE_LIMIT_CODES:
+            raise RateLimited('The facebook quota for oauth is exhausted.')
+        raise ProviderError('Invalid response from Facebook.')
+
+    def graph_batch(self, access_token, relative_urls):
+        """
+        Sends GET requests for each of the given relative URLs to the Graph API
+        as a single batch request, returning a list of the decoded responses
+        (``None`` for any request that Facebook did not answer).
+
+        """
+        batch = [{'method': 'GET', 'relative_url': url} for url in relative_urls]
+        body = urllib.urlencode({'access_token': access_token, 'batch': json.dumps(batch)})
+        status, headers, content = transport.request(self.graph_url, 'POST', body,
+            {'Content-Type': 'application/x-www-form-urlencoded'}, service=self.service, endpoint='graph')
+        if status != 200:
+            raise ProviderError('Invalid response from Facebook.')
+        return json.loads(content)
+
+    def get_avatar(self, response):
+        """
+        Returns the URL of a picture from the response to a batched
+        ``picture`` request.
+
+        """
+        if response is None:
+            return ''
+        if response['code'] == 200:
+            return json.loads(response['body']).get('data', {}).get('url', '')
+        # Older versions of the Graph API answer with a redirect to the
+        # picture itself.
+        for header in response.get('headers', []):
+            if header['name'].lower() == 'location':
+                return header['value']
+        return ''
+
+    def get_profile(self, access_token):
+        """
+        Fetches the authenticated user's profile and picture in a single
+        round trip using a Graph API batch request, returning a ``Profile``.
+
+        """
+        me, picture = self.graph_batch(access_token, ['me', 'me/picture?redirect=false'])
+        if me is None or me['code'] != 200:
+            raise ProviderError('Invalid response from Facebook.')
+        return Profile(json.loads(me['body']), self.get_avatar(picture))
+
+    def fetch_profiles(self, identifiers, cache=True):
+        """
+        Fetches the profiles and pictures of many users at once using the
+        application's access token, returning a dictionary of ``Profile``
+        objects keyed by identifier. Users that could not be fetched are
+        left out. The profiles are also stored in the profile cache unless
+        ``cache`` is false.
+
+        """
+        access_token = '%s|%s' % (settings.FACEBOOK_APPLICATION_ID, settings.FACEBOOK_SECRET_KEY)
+        relative_urls = []
+        for identifier in identifiers:
+            relative_urls.append('%s' % identifier)
+            relative_urls.append('%s/picture?redirect=false' % identifier)
+        responses = self.graph_batch(access_token, relative_urls)
+
+        profiles = {}
+        for identifier, i in zip(identifiers, range(0, len(responses), 2)):
+            user, picture = responses[i], responses[i + 1]
+            if user is not None and user['code'] == 200:
+                profiles[str(identifier)] = Profile(json.loads(user['body']), self.get_avatar(picture))
+                if cache:
+                    profile_cache.set(self.service, identifier, profiles[str(identifier)])
+        return profiles
+
+    def get_association_fields(self, profile):
+        """
+        Returns the ``Association`` fields derived from a profile.
+
+        """
+        return {'avatar': profile.avatar, 'profile_url': profile['link']}
 
     def prepare(self, request, **kwargs):
         """
@@ -72,10 +257,19 @@ class AccountBackend(DefaultBackend):
         self.parameters['code'] = request.GET.get('code')
         self.parameters['redirect_uri'] = request.build_absolute_uri(request.path)
 
-        response = urlparse.parse_qs(urllib.urlopen('%s?%s' % (self.access_token_url, urllib.urlencode(self.parameters))).read())
-        self.access_token = response['access_token'][-1]
-        self.profile = json.load(urllib.urlopen('%s?%s' % (self.graph_url, urllib.urlencode({'access_token': self.access_token}))))
-        return authenticate(identifier=self.profile['id'])
+        with timed(self.service, 'token_exchange'):
+            # The code can only be exchanged once.
+            status, headers, content = transport.request('%s?%s' % (self.access_token_url, urllib.urlencode(self.parameters)),
+                service=self.service, endpoint='oauth', idempotent=False)
+        if status != 200:
+            raise ProviderError('Invalid response from Facebook.')
+        self.access_token, self.expires_at = self.parse_access_token(content)
+
+        with timed(self.service, 'profile_fetch'):
+            self.profile = self.get_profile(self.access_token)
+        profile_cache.set(self.service, self.profile['id'], self.profile)
+        with timed(self.service, 'association_query'):
+            return authenticate(service=self.service, identifier=self.profile['id'])
 
     def create_user(self, request, user, **kwargs):
         """
@@ -83,9 +277,13 @@ class AccountBackend(DefaultBackend):
         them to registration to set a username and password.
 
         """
-        request.session['facebook_access_token'] = self.access_token
-        request.session['facebook_identifier'] = self.profile['id']
-        request.session['facebook_profile'] = self.profile
+        with timed(self.service, 'registration_state'):
+            RegistrationState(
+                service=self.service,
+                identifier=self.profile['id'],
+                access_token=self.access_token,
+                expires_at=self.expires_at and self.expires_at.isoformat()
+            ).save(request)
         return redirect('facebook-setup')
 
     def link_user(self, request, user, **kwargs):
@@ -95,32 +293,55 @@ class AccountBackend(DefaultBackend):
         We don't need to log them in though since they've already done so.
 
         """
-        association = Association.get_or_create(
-            access_token=self.access_token,
-            avatar=request.facebook.graph.get_connections(self.profile['id'], 'picture'),
-            identifier=self.profile['id'],
-            is_active=True,
-            profile_url=self.profile['link'],
-            service=self.service,
-            user=request.user
-        )
-        association.save()
+        with timed(self.service, 'association_update'):
+            association, created = Association.objects.get_or_create(
+                identifier=self.profile['id'],
+                service=self.service,
+                defaults={
+                    'access_token': self.access_token,
+                    'avatar': self.profile.avatar,
+                    'expires_at': self.expires_at,
+                    'profile_url': self.profile['link'],
+                    'user': request.user
+                }
+            )
+            if not created:
+                association.access_token = self.access_token
+                association.avatar = self.profile.avatar
+                association.expires_at = self.expires_at
+                association.is_active = True
+                association.is_token_valid = True
+                association.profile_url = self.profile['link']
+                association.user = request.user
+                association.save(force_update=True)
         messages.success(request, 'Your Facebook account has been linked with your Hello! Ranking account.')
         return redirect('edit-profile')
 
     def grant_user(self, request, user, **kwargs):
         """
         ``authenticate()`` worked and the user has an ``Association`` already,
-        so let's fetch it and log them in.
+        so let's update it and log them in.
 
         """
-        association = Association.objects.get(user=user, service=self.service)
-        association.access_token = self.access_token
-        association.avatar = request.facebook.graph.get_connections(self.profile['id'], 'picture')
-        association.profile_url = self.profile['link']
-        association.save()
+        with timed(self.service, 'association_update'):
+            association_id = self.get_association_id(user, self.profile['id'])
+            fields = {
+                'access_token': self.access_token,
+                'expires_at': self.expires_at,
+                'is_token_valid': True
+            }
+            # Keep what we already have if the optional parts of the profile
+            # could not be fetched.
+            if self.profile.avatar:
+                fields['avatar'] = self.profile.avatar
+            if self.profile.get('link'):
+                fields['profile_url'] = self.profile['link']
+            # Written with ``update()``: a new token does not change who the
+            # association logs in, so the cached user is left in place.
+            Association.objects.filter(pk=association_id).update(**fields)
         if user.is_active:
-            login(request, user)
+            with timed(self.service, 'login'):
+                login(request, user)
             messages.success(request, 'Welcome back! You have been logged in!')
             return redirect('site-home')
 
@@ -132,6 +353,7 @@ class AccountBackend(DefaultBackend):
         """
         association = Association.objects.get(user=request.user, service=self.service)
         association.is_active = False
+        association.save(force_update=True)
         return True
 
 
@@ -157,29 +379,38 @@ class RegistrationBackend(object):
         and a relation to the Facebook user they authenticated with.
 
         """
-        # Let's alias some of these session variables.
-        access_token = request.session['facebook_access_token']
-        identifier = request.session['facebook_identifier']
-        profile = request.session['facebook_profile']
+        state = RegistrationState.load(request, 'facebook')
+
+        # The profile was cached by ``AccountBackend.authenticate()``; it is
+        # fetched again only if it has since been evicted.
+        backend = get_backend('social_registration.backends.facebook.AccountBackend')
+        profile = profile_cache.get('facebook', state.identifier, lambda: backend.get_profile(state.access_token))
 
         username, email = kwargs['username'], kwargs['email']
-        user = User.objects.create_user(username, email)
-        user.first_name = profile['first_name']
-        user.last_name = profile['last_name']
-        user.set_unusable_password()
-        user.save()
-
-        association = Association(
-            access_token=access_token,
-            avatar=request.facebook.graph.get_connections(identifier, 'picture'),
-            identifier=identifier,
-            is_active=True,
-            profile_url=profile['link'],
-            service='facebook',
-            user=user
-        )
-        association.save()
-        signals.user_registered.send(sender=self.__class__, user=user, request=request)
+        with query_budget('register'):
+            # Built in full so that it is saved with a single INSERT.
+            user = User(
+                email=User.objects.normalize_email(email),
+                first_name=profile['first_name'],
+                last_name=profile['last_name'],
+                username=username
+            )
+            user.set_unusable_password()
+            user.save()
+
+            association = Association(
+                access_token=state.access_token,
+                avatar=profile.avatar,
+                expires_at=state.expires_at and parse_datetime(state.expires_at),
+                identifier=state.identifier,
+                is_active=True,
+                profile_url=profile['link'],
+                service='facebook',
+                user=user
+            )
+            association.save()
+            RegistrationState.clear(request)
+        notify_user_registered(self.__class__, user, request)
         return user
 
     def registration_allowed(self, request):
@@ -194,15 +425,32 @@ class RegistrationBackend(object):
         *  If ``FACEBOOK_REGISTRATION_OPEN`` is both specified and set to
            ``False``, registration is not permitted.
 
+        Registration is never permitted without a ``RegistrationState`` left
+        in the session by ``AccountBackend.create_user()``.
+
         """
+        if RegistrationState.load(request, 'facebook') is None:
+            return False
         return getattr(settings, 'FACEBOOK_REGISTRATION_OPEN', True)
 
     def get_form_class(self, request):
         """
-        Return the default form class used for user registration.
+        Return the default form class used for user registration, which
+        suggests usernames based on the user's Facebook username and name.
 
         """
-        return UserForm
+        state = RegistrationState.load(request, 'facebook')
+        if state is None:
+            return UserForm
+        profile = profile_cache.peek('facebook', state.identifier)
+        if profile is None:
+            return UserForm
+        return UserForm.for_profile('facebook:%s' % state.identifier, [
+            profile.get('username'),
+            profile.get('name'),
+            profile.get('first_name'),
+            profile.get('last_name')
+        ])
 
     def post_registration_redirect(self, request, user):
         """
@@ -1,19 +1,80 @@
 import facebook
+import hashlib
+import time
 
 from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from social_registration.cache import LRUCache
+
+
+# Users parsed from cookies whose signature has already been verified, keyed
+# by a digest of the cookie.
+cookie_cache = LRUCache(getattr(settings, 'FACEBOOK_COOKIE_CACHE_SIZE', 1000))
+
+
+def get_user_from_cookie(cookies):
+    """
+    A memoized ``facebook.get_user_from_cookie()``. A cookie whose signature
+    has been verified once is not verified again until it expires or is
+    evicted from ``cookie_cache``.
+
+    """
+    cookie = cookies.get('fbs_' + settings.FACEBOOK_API_KEY, '')
+    if not cookie:
+        return None
+    key = hashlib.sha1(cookie.encode('utf-8')).hexdigest()
+    user = cookie_cache.get(key)
+    if user is None:
+        user = facebook.get_user_from_cookie(cookies, settings.FACEBOOK_API_KEY, settings.FACEBOOK_SECRET_KEY)
+        if user is None:
+            return None
+        expires = int(user.get('expires', 0) or 0)
+        if expires:
+            if expires <= time.time():
+                return None
+            cookie_cache.set(key, user, expires - time.time())
+        else:
+            cookie_cache.set(key, user)
+    return user
 
 
 class Facebook(object):
     def __init__(self, user=None):
+        self._graph = None
         if user is None:
             self.identifier = None
         else:
             self.identifier = user['uid']
             self.user = user
-            self.graph = facebook.GraphAPI(user['access_token'])
+
+    @property
+    def graph(self):
+        """
+        The ``GraphAPI`` for the connected user, built on first access.
+
+        """
+        if self._graph is None and self.identifier is not None:
+            self._graph = facebook.GraphAPI(self.user['access_token'])
+        return self._graph
 
 
 class FacebookMiddleware(object):
+    """
+    Enables ``request.facebook`` and ``request.facebook.graph`` in views.
+
+    The Facebook cookie is only parsed and verified when ``request.facebook``
+    is first used. Requests whose path starts with one of the prefixes in the
+    ``FACEBOOK_MIDDLEWARE_EXCLUDE_PATHS`` setting, or, if the
+    ``FACEBOOK_MIDDLEWARE_INCLUDE_PATHS`` setting is given, with none of its
+    prefixes, are given an empty ``Facebook`` object without looking at the
+    cookie at all.
+
+    """
+    def __init__(self):
+        self.exclude_paths = tuple(getattr(settings, 'FACEBOOK_MIDDLEWARE_EXCLUDE_PATHS', ()))
+        self.include_paths = tuple(getattr(settings, 'FACEBOOK_MIDDLEWARE_INCLUDE_PATHS', ()))
+
     def process_request(self, request):
         """
         Enables ``request.facebook`` and ``request.facebook.graph`` in views
@@ -21,8 +82,13 @@ class FacebookMiddleware(object):
         Platform.
 
         """
-        facebook_user = facebook.get_user_from_cookie(request.COOKIES, settings.FACEBOOK_API_KEY, settings.FACEBOOK_SECRET_KEY)
-        request.facebook = Facebook(facebook_user)
-        return None
+        path = request.path_info
+        if (self.exclude_paths and path.startswith(self.exclude_paths)) or \
+                (self.include_paths and not path.startswith(self.include_paths)):
+            request.facebook = Facebook()
+            return None
 
+        cookies = request.COOKIES
+        request.facebook = SimpleLazyObject(lambda: Facebook(get_user_from_cookie(cookies)))
+        return None
 
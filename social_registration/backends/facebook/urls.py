@@ -11,7 +11,7 @@ urlpatterns = patterns('',
     url(r'^facebook/setup/$',
         view    = 'registration.views.register',
         kwargs  = {
-            'backend': 'registration.backends.facebook.FacebookBackend',
+            'backend': 'social_registration.backends.facebook.RegistrationBackend',
             'template_name': 'facebook/user_form.html'
         },
         name    = 'facebook-setup'
@@ -34,26 +34,26 @@ urlpatterns = patterns('',
 )
 
 
-urlpatterns = patterns('',
+urlpatterns += patterns('',
 
     url(r'^facebook/prepare/$',
-        view    = 'accounts.views.prepare',
+        view    = 'social_registration.views.prepare',
         kwargs  = {
-            'backend': 'accounts.backends.facebook.FacebookBackend',
+            'backend': 'social_registration.backends.facebook.AccountBackend',
         },
         name    = 'facebook-prepare'
     ),
     url(r'^facebook/authenticate/$',
-        view    = 'accounts.views.authenticate',
+        view    = 'social_registration.views.authenticate',
         kwargs  = {
-            'backend': 'accounts.backends.facebook.FacebookBackend',
+            'backend': 'social_registration.backends.facebook.AccountBackend',
         },
         name    = 'facebook-authentication'
     ),
     url(r'^facebook/deauthenticate/$',
-        view    = 'accounts.views.deauthenticate',
+        view    = 'social_registration.views.deauthenticate',
         kwargs  = {
-            'backend': 'accounts.backends.facebook.FacebookBackend',
+            'backend': 'social_registration.backends.facebook.AccountBackend',
         },
         name    = 'facebook-deauthentication'
     )
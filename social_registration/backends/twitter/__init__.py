@@ -1,27 +1,53 @@
+import json
 import oauth2 as oauth
-import twitter
+import urllib
 import urlparse
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
-from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import redirect
 
-from registration import signals
-from registration.forms import UserForm
-from social_registration.backends.default import AccountBackend as DefaultBackend
+from social_registration.backends import get_backend
+from social_registration.backends.default import AuthenticationBackend as BaseAuthenticationBackend
+from social_registration.backends.default import DefaultBackend
+from social_registration.exceptions import ProviderError, RateLimited
+from social_registration.flow import flow_store
+from social_registration.forms import UserForm
+from social_registration.instrumentation import timed
 from social_registration.models import Association
+from social_registration.profiles import profile_cache
+from social_registration.queries import query_budget
+from social_registration.state import RegistrationState, log_session_size
+from social_registration.tasks import defer, notify_user_registered
+from social_registration.transport import transport
 
 
-class AuthenticationBackend(ModelBackend):
-    def authenticate(self, identifier=None):
-        try:
-            association = Association.objects.get(identifier=identifier, service='twitter')
-            return association.user
-        except (Association.DoesNotExist, User.DoesNotExist):
-            return None
+class AuthenticationBackend(BaseAuthenticationBackend):
+    service = 'twitter'
+
+
+def refresh_avatar(association_id):
+    """
+    A task which updates the avatar of a Twitter ``Association`` from the
+    user's current profile.
+
+    """
+    association = Association.objects.get(pk=association_id)
+    profile = get_backend('social_registration.backends.twitter.AccountBackend').get_profile(association.identifier)
+    if association.avatar != profile['profile_image_url']:
+        Association.objects.filter(pk=association_id).update(avatar=profile['profile_image_url'])
+
+
+def prefetch_profile(identifier):
+    """
+    A task which loads a Twitter user's profile into the profile cache ahead
+    of it being needed, e.g. by the registration form.
+
+    """
+    get_backend('social_registration.backends.twitter.AccountBackend').get_profile(identifier)
 
 
 class AccountBackend(DefaultBackend):
@@ -30,34 +56,142 @@ class AccountBackend(DefaultBackend):
     Twitter (OAuth 1.0).
 
     """
-    def __init__(self, *args, **kwargs):
-        # URLs
-        self.access_token_url = 'https://api.twitter.com/oauth/access_token'
-        self.authenticate_url = 'http://api.twitter.com/oauth/authenticate'
-        self.request_token_url = 'https://api.twitter.com/oauth/request_token'
-        self.profile_url = 'http://twitter.com/%s'
+    # URLs
+    access_token_url = 'https://api.twitter.com/oauth/access_token'
+    authenticate_url = 'http://api.twitter.com/oauth/authenticate'
+    request_token_url = 'https://api.twitter.com/oauth/request_token'
+    profile_url = 'http://twitter.com/%s'
+    users_lookup_url = 'https://api.twitter.com/1/users/lookup.json'
+    users_show_url = 'https://api.twitter.com/1/users/show.json'
 
+    # Twitter's users/lookup accepts up to 100 users per call.
+    batch_size = 100
+
+    # Shared Configuration
+    consumer = None
+    service = 'twitter'
+
+    def __init__(self, *args, **kwargs):
         # Instance Variables
         self.access_token = None
-        self.consumer = oauth.Consumer(settings.TWITTER_KEY, settings.TWITTER_SECRET)
         self.identifier = None
-        self.service = 'twitter'
         super(AccountBackend, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def configure(cls):
+        """
+        Builds the OAuth consumer shared by every request from the
+        ``TWITTER_KEY`` and ``TWITTER_SECRET`` settings.
+
+        If the ``TWITTER_API_URL`` setting is given, every call is made to
+        that URL instead of api.twitter.com (e.g., to a stand-in for load
+        testing).
+
+        """
+        key = getattr(settings, 'TWITTER_KEY', None)
+        secret = getattr(settings, 'TWITTER_SECRET', None)
+        if not key or not secret:
+            raise ImproperlyConfigured('The Twitter account backend requires the TWITTER_KEY and TWITTER_SECRET settings.')
+        cls.consumer = oauth.Consumer(key, secret)
+        api_url = getattr(settings, 'TWITTER_API_URL', None)
+        if api_url:
+            cls.access_token_url = urlparse.urljoin(api_url, 'oauth/access_token')
+            cls.authenticate_url = urlparse.urljoin(api_url, 'oauth/authenticate')
+            cls.request_token_url = urlparse.urljoin(api_url, 'oauth/request_token')
+            cls.users_lookup_url = urlparse.urljoin(api_url, '1/users/lookup.json')
+            cls.users_show_url = urlparse.urljoin(api_url, '1/users/show.json')
+        if getattr(settings, 'SOCIAL_REGISTRATION_HTTP_PREWARM', False):
+            transport.warm([cls.request_token_url, cls.users_show_url])
+
+    def oauth_request(self, url, token=None, endpoint='oauth', essential=True, idempotent=True):
+        """
+        Signs a GET request to one of Twitter's OAuth endpoints and sends it
+        through the shared transport, metered as a call to ``endpoint``.
+        One-shot calls pass ``idempotent=False`` so that they are never sent
+        twice.
+
+        """
+        signed = oauth.Request.from_consumer_and_token(self.consumer,
+            token=token, http_method='GET', http_url=url)
+        signed.sign_request(oauth.SignatureMethod_HMAC_SHA1(), self.consumer, token)
+        return transport.request(signed.to_url(), service=self.service, endpoint=endpoint, essential=essential,
+            idempotent=idempotent)
+
+    def get_profile(self, identifier):
+        """
+        Returns the public profile of the given Twitter user from the shared
+        profile cache, fetching it only when it is missing or stale.
+
+        """
+        return profile_cache.get(self.service, identifier, lambda: self.fetch_profile(identifier))
+
+    def fetch_profile(self, identifier):
+        """
+        Fetches the public profile of the given Twitter user. Profiles are
+        only ever needed to refresh an association, so the call is the first
+        to be refused when the quota runs low.
+
+        """
+        status, headers, content = transport.request('%s?%s' % (self.users_show_url, urllib.urlencode({'user_id': identifier})),
+            service=self.service, endpoint='users/show', essential=False)
+        if status != 200:
+            raise ProviderError('Invalid response from Twitter.')
+        return json.loads(content)
+
+    def fetch_profiles(self, identifiers, cache=True):
+        """
+        Fetches the public profiles of many Twitter users in one call,
+        returning a dictionary keyed by identifier. The call is made on behalf
+        of the ``TWITTER_ACCESS_TOKEN`` and ``TWITTER_ACCESS_TOKEN_SECRET``
+        settings if given. Users that could not be fetched are left out.
+        The profiles are also stored in the profile cache unless ``cache`` is
+        false.
+
+        """
+        token = None
+        if getattr(settings, 'TWITTER_ACCESS_TOKEN', None):
+            token = oauth.Token(settings.TWITTER_ACCESS_TOKEN, settings.TWITTER_ACCESS_TOKEN_SECRET)
+        url = '%s?%s' % (self.users_lookup_url, urllib.urlencode({'user_id': ','.join(map(str, identifiers))}))
+        status, headers, content = self.oauth_request(url, token, 'users/lookup')
+        if status == 404:
+            return {}
+        if status == 429:
+            raise RateLimited('The twitter quota for users/lookup is exhausted.')
+        if status != 200:
+            raise ProviderError('Invalid response from Twitter.')
+        profiles = {}
+        for profile in json.loads(content):
+            profiles[str(profile['id'])] = profile
+            if cache:
+                profile_cache.set(self.service, profile['id'], profile)
+        return profiles
+
+    def get_association_fields(self, profile):
+        """
+        Returns the ``Association`` fields derived from a profile.
+
+        """
+        return {
+            'avatar': profile['profile_image_url'],
+            'profile_url': self.profile_url % profile['screen_name']
+        }
+
     def prepare(self, request, **kwargs):
         """
         Handles the preliminary steps between the site and Twitter's OAuth
         platform. A request token is sent and validated to receive an
-        authorization URL which the user is then redirected to.
+        authorization URL which the user is then redirected to. The token's
+        secret is kept in the flow store until the user comes back.
 
         """
-        client = oauth.Client(self.consumer)
-        response, content = client.request(self.request_token_url, 'GET')
-        if response['status'] != '200':
-            raise Exception('Invalid response from Twitter.')
-        request.session['request_token'] = dict(urlparse.parse_qsl(content))
-        url = '%s?oauth_token=%s' % (self.authenticate_url, request.session['request_token']['oauth_token'])
-        return url
+        with timed(self.service, 'request_token'):
+            status, headers, content = self.oauth_request(self.request_token_url)
+        if status != 200:
+            raise ProviderError('Invalid response from Twitter.')
+        request_token = dict(urlparse.parse_qsl(content))
+        flow_store.save(request, request_token['oauth_token'], request_token['oauth_token_secret'])
+        log_session_size(request, 'Twitter preparation')
+        return '%s?oauth_token=%s' % (self.authenticate_url, request_token['oauth_token'])
 
     def authenticate(self, request, **kwargs):
         """
@@ -76,27 +210,38 @@ class AccountBackend(DefaultBackend):
         }
 
         """
-        token = oauth.Token(
-            request.session['request_token']['oauth_token'],
-            request.session['request_token']['oauth_token_secret']
-        )
-        client = oauth.Client(self.consumer, token)
-        response, content = client.request(self.access_token_url, 'GET')
-        if response['status'] != '200':
-            raise Exception('Invalid response from Twitter.')
+        oauth_token = request.GET.get('oauth_token')
+        oauth_token_secret = oauth_token and flow_store.pop(request, oauth_token)
+        if not oauth_token_secret:
+            raise ProviderError('Unknown or expired request token.')
+        token = oauth.Token(oauth_token, oauth_token_secret)
+        with timed(self.service, 'token_exchange'):
+            # The verifier can only be exchanged once.
+            status, headers, content = self.oauth_request(self.access_token_url, token, idempotent=False)
+        if status != 200:
+            raise ProviderError('Invalid response from Twitter.')
             return (False, None)
         self.access_token = dict(urlparse.parse_qsl(content))
         self.identifier = self.access_token['user_id']
-        return authenticate(identifier=self.identifier)
+        with timed(self.service, 'association_query'):
+            return authenticate(service=self.service, identifier=self.identifier)
 
     def create_user(self, request, user, **kwargs):
         """
         ``authenticate()`` returned ``None``, so the user is new. Let's send
-        them to registration to set a username and password.
+        them to registration to set a username and password. Their profile
+        is fetched in the background while they fill in the form.
 
         """
-        request.session['twitter_profile'] = twitter.Twitter().users.show(id=self.identifier)
-        request.session['twitter_identifier'] = self.identifier
+        with timed(self.service, 'registration_state'):
+            RegistrationState(
+                service=self.service,
+                identifier=self.identifier,
+                access_token=self.access_token['oauth_token'],
+                access_token_secret=self.access_token['oauth_token_secret'],
+                screen_name=self.access_token['screen_name']
+            ).save(request)
+        defer('social_registration.backends.twitter.prefetch_profile', self.identifier)
         return redirect('twitter-setup')
 
     def link_user(self, request, user, **kwargs):
@@ -104,45 +249,53 @@ class AccountBackend(DefaultBackend):
         ``authenticate()`` worked, so we have an existing user trying to
         connect, but they don't have an Association yet, so let's create one.
         We don't need to log them in though since they've already done so.
+        Their avatar is fetched in the background.
 
         """
-        profile = twitter.Twitter().users.show(id=self.identifier)
-        association = Association.get_or_create(
-            access_token={
-                'oauth_token': self.access_token['oauth_token'],
-                'oauth_token_secret': self.access_token['oauth_token_secret']
-            },
-            avatar=profile['profile_image_url'],
-            identifier=self.identifier,
-            is_active=True,
-            profile_url=self.profile_url % self.access_token['name'],
-            service=self.service,
-            user=user
-        )
-        association.save()
+        profile_url = self.profile_url % self.access_token['screen_name']
+        with timed(self.service, 'association_update'):
+            association, created = Association.objects.get_or_create(
+                identifier=self.identifier,
+                service=self.service,
+                defaults={
+                    'access_token': self.access_token['oauth_token'],
+                    'access_token_secret': self.access_token['oauth_token_secret'],
+                    'profile_url': profile_url,
+                    'user': request.user
+                }
+            )
+            if not created:
+                association.access_token = self.access_token['oauth_token']
+                association.access_token_secret = self.access_token['oauth_token_secret']
+                association.is_active = True
+                association.is_token_valid = True
+                association.profile_url = profile_url
+                association.user = request.user
+                association.save(force_update=True)
+        defer('social_registration.backends.twitter.refresh_avatar', association.pk)
         messages.success(request, 'Your Twitter account has been linked with your Hello! Ranking account.')
         return redirect('edit-profile')
 
     def grant_user(self, request, user, **kwargs):
         """
         ``authenticate()`` worked and the user has an ``Association`` already,
-        so let's fetch it and log them in.
-
-        """
-        try:
-            twitter_profile = twitter.Twitter().users.show(id=self.access_token['user_id'])
-            avatar = twitter_profile['profile_image_url']
-        except:
-            avatar = ''
-        association = Association.objects.get(identifier=self.access_token['user_id'], service=self.service)
-        association.access_token = {
-            'oauth_token': self.access_token['oauth_token'],
-            'oauth_token_secret': self.access_token['oauth_token_secret']
-        }
-        association.avatar = avatar
-        association.save()
+        so let's update it and log them in. Their avatar is refreshed in the
+        background.
+
+        """
+        with timed(self.service, 'association_update'):
+            association_id = self.get_association_id(user, self.identifier)
+            # Written with ``update()``: a new token does not change who the
+            # association logs in, so the cached user is left in place.
+            Association.objects.filter(pk=association_id).update(
+                access_token=self.access_token['oauth_token'],
+                access_token_secret=self.access_token['oauth_token_secret'],
+                is_token_valid=True
+            )
+        defer('social_registration.backends.twitter.refresh_avatar', association_id)
         if user.is_active:
-            login(request, user)
+            with timed(self.service, 'login'):
+                login(request, user)
             messages.success(request, 'Welcome back! You have been logged in!')
             return redirect('site-home')
 
@@ -154,6 +307,7 @@ class AccountBackend(DefaultBackend):
         """
         association = Association.objects.get(user=request.user, service=self.service)
         association.is_active = False
+        association.save(force_update=True)
         return True
 
 
@@ -178,29 +332,26 @@ class RegistrationBackend(object):
         and a relation to the Twitter user they authenticated with.
 
         """
-        # Let's alias some of these session variables.
-        identifier = request.session['twitter_identifier']
-        profile = request.session['twitter_profile']
+        state = RegistrationState.load(request, 'twitter')
 
         username, email = kwargs['username'], kwargs['email']
-        user = User.objects.create_user(username, email)
-        user.set_unusable_password()
-        user.save()
-
-        association = Association(
-            access_token={
-                'oauth_token': request.session['request_token']['oauth_token'],
-                'oauth_token_secret': request.session['request_token']['oauth_token_secret']
-            },
-            avatar=profile['profile_image_url'],
-            identifier=identifier,
-            is_active=True,
-            profile_url=self.profile_url % self.access_token['name'],
-            service='twitter',
-            user=user
-        )
-        association.save()
-        signals.user_registered.send(sender=self.__class__, user=user, request=request)
+        with query_budget('register'):
+            # Without a password the user is created with an unusable one.
+            user = User.objects.create_user(username, email)
+
+            association = Association(
+                access_token=state.access_token,
+                access_token_secret=state.access_token_secret,
+                identifier=state.identifier,
+                is_active=True,
+                profile_url=AccountBackend.profile_url % state.screen_name,
+                service='twitter',
+                user=user
+            )
+            association.save()
+            RegistrationState.clear(request)
+            defer('social_registration.backends.twitter.refresh_avatar', association.pk)
+        notify_user_registered(self.__class__, user, request)
         return user
 
     def registration_allowed(self, request):
@@ -215,15 +366,25 @@ class RegistrationBackend(object):
         *  If ``TWITTER_REGISTRATION_OPEN`` is both specified and set to
            ``False``, registration is not permitted.
 
+        Registration is never permitted without a ``RegistrationState`` left
+        in the session by ``AccountBackend.create_user()``.
+
         """
+        if RegistrationState.load(request, 'twitter') is None:
+            return False
         return getattr(settings, 'TWITTER_REGISTRATION_OPEN', True)
 
     def get_form_class(self, request):
         """
-        Return the default form class used for user registration.
+        Return the default form class used for user registration, which
+        suggests usernames based on the user's Twitter screen name and name.
 
         """
-        return UserForm
+        state = RegistrationState.load(request, 'twitter')
+        if state is None:
+            return UserForm
+        profile = profile_cache.peek('twitter', state.identifier) or {}
+        return UserForm.for_profile('twitter:%s' % state.identifier, [state.screen_name, profile.get('name')])
 
     def post_registration_redirect(self, request, user):
         """
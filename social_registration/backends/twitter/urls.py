@@ -11,7 +11,7 @@ urlpatterns = patterns('',
     url(r'^twitter/setup/$',
         view    = 'registration.views.register',
         kwargs  = {
-            'backend': 'registration.backends.twitter.TwitterBackend',
+            'backend': 'social_registration.backends.twitter.RegistrationBackend',
             'template_name': 'twitter/user_form.html'
         },
         name    = 'twitter-setup'
@@ -39,21 +39,21 @@ urlpatterns += patterns('',
     url(r'^twitter/prepare/$',
         view    = 'social_registration.views.prepare',
         kwargs  = {
-            'backend': 'social_registration.backends.twitter.TwitterBackend',
+            'backend': 'social_registration.backends.twitter.AccountBackend',
         },
         name    = 'twitter-prepare'
     ),
     url(r'^twitter/authenticate/$',
         view    = 'social_registration.views.authenticate',
         kwargs  = {
-            'backend': 'social_registration.backends.twitter.TwitterBackend',
+            'backend': 'social_registration.backends.twitter.AccountBackend',
         },
         name    = 'twitter-authenticate'
     ),
     url(r'^twitter/deauthenticate/$',
         view    = 'social_registration.views.deauthenticate',
         kwargs  = {
-            'backend': 'social_registration.backends.twitter.TwitterBackend',
+            'backend': 'social_registration.backends.twitter.AccountBackend',
         },
         name    = 'twitter-deauthenticate'
     )
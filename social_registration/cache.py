@@ -0,0 +1,158 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe, in-process cache which discards the least
+    recently used entry once ``max_size`` is reached. Entries may optionally
+    expire after ``timeout`` seconds.
+
+    Hits, misses and evictions are counted and available from ``stats()``.
+
+    """
+    def __init__(self, max_size=1000, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # Re-inserting moves the key to the most recently used end.
+            self.entries[key] = (value, expires)
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = timeout is not None and time.time() + timeout or None
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.entries[key] = (value, expires)
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'evictions': self.evictions,
+            'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+
+class AssociationCache(object):
+    """
+    Caches the ``User`` associated with a ``(service, identifier)`` pair in
+    two tiers: a small in-process LRU in front of Django's cache framework.
+
+    The in-process tier cannot be invalidated from other processes, so its
+    entries live for ``local_timeout`` seconds only. Both tiers are
+    invalidated through the signal handlers connected in
+    ``social_registration.models`` when a ``User`` is saved, or an
+    ``Association`` changes user, identity or ``is_active``. The token and
+    ``last_login`` writes of a login go through ``update()`` and leave the
+    entry in place.
+
+    Enabled by the ``SOCIAL_REGISTRATION_CACHE`` setting; when disabled every
+    lookup is a miss and nothing is stored.
+
+    """
+    def __init__(self, enabled=False, max_size=1000, local_timeout=30, timeout=300):
+        self.enabled = enabled
+        self.local = LRUCache(max_size, local_timeout)
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, service, identifier):
+        return 'social_registration:association:%s:%s' % (service, identifier)
+
+    def get(self, service, identifier):
+        if not self.enabled:
+            return None
+        key = self.key(service, identifier)
+        user = self.local.get(key)
+        if user is None:
+            user = cache.get(key)
+            if user is None:
+                self.misses += 1
+                return None
+            self.local.set(key, user)
+        self.hits += 1
+        return user
+
+    def set(self, service, identifier, user):
+        if not self.enabled:
+            return
+        key = self.key(service, identifier)
+        self.local.set(key, user)
+        cache.set(key, user, self.timeout)
+
+    def delete(self, service, identifier):
+        key = self.key(service, identifier)
+        self.local.delete(key)
+        if self.enabled:
+            cache.delete(key)
+
+    def stats(self):
+        """
+        Return the overall hit and miss counts along with the counters of the
+        in-process tier.
+
+        """
+        return {
+            'hits': self.hits,
+            'local': self.local.stats(),
+            'misses': self.misses
+        }
+
+
+association_cache = AssociationCache(
+    enabled=getattr(settings, 'SOCIAL_REGISTRATION_CACHE', False),
+    max_size=getattr(settings, 'SOCIAL_REGISTRATION_CACHE_SIZE', 1000),
+    local_timeout=getattr(settings, 'SOCIAL_REGISTRATION_CACHE_LOCAL_TIMEOUT', 30),
+    timeout=getattr(settings, 'SOCIAL_REGISTRATION_CACHE_TIMEOUT', 300)
+)
+
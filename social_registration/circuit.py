@@ -0,0 +1,78 @@
+import threading
+import time
+
+from django.conf import settings
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of each external service so that, once it has failed
+    ``threshold`` times in a row, calls to it fail straight away instead of
+    tying up a worker until they time out.
+
+    After ``reset_timeout`` seconds a single probe call is let through: if it
+    succeeds the service is considered healthy again, otherwise it is given
+    another ``reset_timeout`` seconds. State is kept per process.
+
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def get_circuit(self, service):
+        return self.circuits.setdefault(service, {'failures': 0, 'opened_at': 0, 'state': self.CLOSED})
+
+    def allow(self, service):
+        """
+        Return whether a call to the given service may be made now.
+
+        """
+        self.lock.acquire()
+        try:
+            circuit = self.get_circuit(service)
+            if circuit['state'] == self.CLOSED:
+                return True
+            if time.time() - circuit['opened_at'] >= self.reset_timeout:
+                # Let one probe through; should it never report back, another
+                # is let through after a further ``reset_timeout`` seconds.
+                circuit.update(opened_at=time.time(), state=self.HALF_OPEN)
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def success(self, service):
+        self.lock.acquire()
+        try:
+            circuit = self.get_circuit(service)
+            circuit.update(failures=0, state=self.CLOSED)
+        finally:
+            self.lock.release()
+
+    def failure(self, service):
+        self.lock.acquire()
+        try:
+            circuit = self.get_circuit(service)
+            circuit['failures'] += 1
+            if circuit['state'] == self.HALF_OPEN or circuit['failures'] >= self.threshold:
+                circuit.update(opened_at=time.time(), state=self.OPEN)
+        finally:
+            self.lock.release()
+
+    def state(self, service):
+        self.lock.acquire()
+        try:
+            return self.get_circuit(service)['state']
+        finally:
+            self.lock.release()
+
+
+breaker = CircuitBreaker(
+    threshold=getattr(settings, 'SOCIAL_REGISTRATION_CIRCUIT_THRESHOLD', 5),
+    reset_timeout=getattr(settings, 'SOCIAL_REGISTRATION_CIRCUIT_RESET_TIMEOUT', 30)
+)
+
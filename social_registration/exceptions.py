@@ -0,0 +1,45 @@
+class ProviderError(Exception):
+    """
+    Raised when an external service fails to give a usable response.
+
+    """
+    pass
+
+
+class RateLimited(ProviderError):
+    """
+    Raised when a call to an external service is refused because its quota is
+    exhausted. ``retry_after`` is how many seconds until the quota allows
+    another call, if known.
+
+    """
+    def __init__(self, message, retry_after=None):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderUnavailable(ProviderError):
+    """
+    Raised instead of calling an external service while its circuit breaker
+    is open.
+
+    """
+    pass
+
+
+class InvalidToken(ProviderError):
+    """
+    Raised when an external service refuses an access token it will not
+    renew.
+
+    """
+    pass
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a step of a workflow makes more database queries than its
+    budget allows, or repeats a query.
+
+    """
+    pass
@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import constant_time_compare, get_random_string
+from django.utils.importlib import import_module
+
+
+class SessionFlowStore(object):
+    """
+    Keeps the state of an authentication workflow in progress (e.g., an OAuth
+    request token secret) in the user's session.
+
+    """
+    def key(self, key):
+        return 'social_registration_flow:%s' % key
+
+    def save(self, request, key, value):
+        request.session[self.key(key)] = value
+
+    def pop(self, request, key):
+        return request.session.pop(self.key(key), None)
+
+    def process_response(self, request, response):
+        pass
+
+
+class CacheFlowStore(object):
+    """
+    Keeps the state of an authentication workflow in progress in Django's
+    cache framework, keyed by a value the external service hands back to the
+    callback (e.g., the OAuth request token). Neither step of the workflow
+    writes to the session, and workflows that are abandoned simply expire
+    after ``SOCIAL_REGISTRATION_FLOW_TIMEOUT`` seconds.
+
+    The value the service hands back is no secret, so each workflow is bound
+    to the browser that started it by a random nonce, kept with the state
+    and in a signed cookie set by ``process_response()``. The callback only
+    gets the state back in that browser, which keeps anyone else holding the
+    token from finishing the workflow in another person's session (e.g., to
+    log them in as, or link them to, the attacker's account).
+
+    """
+    cookie_name = 'social_registration_flow'
+    salt = 'social_registration.flow'
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'SOCIAL_REGISTRATION_FLOW_TIMEOUT', 600)
+
+    def key(self, key):
+        return 'social_registration:flow:%s' % key
+
+    def get_nonce(self, request):
+        return request.get_signed_cookie(self.cookie_name, None, salt=self.salt, max_age=self.timeout)
+
+    def save(self, request, key, value):
+        # A browser keeps its nonce across workflows, so that it can have
+        # several in progress at once.
+        nonce = self.get_nonce(request) or get_random_string(32)
+        request.social_registration_flow_nonce = nonce
+        cache.set(self.key(key), (nonce, value), self.timeout)
+
+    def pop(self, request, key):
+        state = cache.get(self.key(key))
+        nonce = self.get_nonce(request)
+        if state is None or nonce is None or not constant_time_compare(state[0], nonce):
+            return None
+        cache.delete(self.key(key))
+        return state[1]
+
+    def process_response(self, request, response):
+        """
+        Sets the cookie holding the nonce of a workflow saved while handling
+        the request.
+
+        """
+        nonce = getattr(request, 'social_registration_flow_nonce', None)
+        if nonce is not None:
+            response.set_signed_cookie(self.cookie_name, nonce, salt=self.salt, max_age=self.timeout,
+                httponly=True)
+
+
+def get_flow_store():
+    """
+    Return an instance of the flow store named by the
+    ``SOCIAL_REGISTRATION_FLOW_STORE`` setting, defaulting to
+    ``SessionFlowStore``.
+
+    """
+    path = getattr(settings, 'SOCIAL_REGISTRATION_FLOW_STORE', 'social_registration.flow.SessionFlowStore')
+    i = path.rfind('.')
+    module, attr = path[:i], path[i+1:]
+    try:
+        return getattr(import_module(module), attr)()
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error loading flow store %s: "%s"' % (path, e))
+
+
+flow_store = get_flow_store()
+
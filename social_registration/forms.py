@@ -1,5 +1,6 @@
 from django import forms
-from django.contrib.auth.models import User
+
+from social_registration.usernames import is_taken, suggest_usernames
 
 
 class UserForm(forms.Form):
@@ -7,17 +8,40 @@ class UserForm(forms.Form):
     A form that allows the user to specify a username and email address after
     authenticating with an external service.
 
+    When the chosen username is taken, alternatives built from
+    ``suggestion_names`` are offered in the error and kept in
+    ``suggestions``. Use ``for_profile()`` to make a form for a particular
+    user's names.
+
     """
+    suggestion_key = None
+    suggestion_names = ()
+
     username = forms.RegexField(r'\w+', max_length=255)
     email = forms.EmailField()
 
     def __init__(self, *args, **kwargs):
         super(UserForm, self).__init__(*args, **kwargs)
+        self.suggestions = []
+
+    @classmethod
+    def for_profile(cls, key, names):
+        """
+        Return a subclass of this form which suggests usernames made from the
+        given names, caching its lookups under ``key``.
+
+        """
+        return type(cls.__name__, (cls,), {
+            'suggestion_key': key,
+            'suggestion_names': tuple(names)
+        })
 
     def clean_username(self):
-        try:
-            user = User.objects.get(username__iexact=self.cleaned_data['username'])
-        except User.DoesNotExist:
-            return self.cleaned_data['username']
-        raise forms.ValidationError('This username is already in use.')
+        username = self.cleaned_data['username']
+        if is_taken(username):
+            self.suggestions = suggest_usernames(username, self.suggestion_names, self.suggestion_key)
+            if self.suggestions:
+                raise forms.ValidationError('This username is already in use. How about %s?' % ', '.join(self.suggestions))
+            raise forms.ValidationError('This username is already in use.')
+        return username
 
@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+
+logger = logging.getLogger('social_registration.instrumentation')
+
+# Sent, with the service as the sender, whenever a timed phase of an
+# authentication workflow finishes. ``duration`` is in seconds and
+# ``outcome`` is e.g. "grant", "link", "create" or "error".
+phase_finished = Signal(providing_args=['phase', 'duration', 'outcome'])
+
+_connected = False
+_connected_lock = threading.Lock()
+
+
+class Timing(object):
+    """
+    A phase being timed by ``timed()``. Set ``outcome`` to describe how it
+    ended; it is "error" if an exception escapes and "ok" if left unset.
+
+    """
+    def __init__(self, service, phase):
+        self.service = service
+        self.phase = phase
+        self.outcome = None
+
+
+def connect_recorders():
+    """
+    Connect the recorders named by the ``SOCIAL_REGISTRATION_RECORDERS``
+    setting to ``phase_finished``, once per process. A path may name a class,
+    which is instantiated, or an instance, which is used as is.
+
+    """
+    global _connected
+    if _connected:
+        return
+    _connected_lock.acquire()
+    try:
+        if _connected:
+            return
+        for path in getattr(settings, 'SOCIAL_REGISTRATION_RECORDERS', ()):
+            i = path.rfind('.')
+            module, attr = path[:i], path[i+1:]
+            try:
+                recorder = getattr(import_module(module), attr)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured('Error loading recorder %s: "%s"' % (path, e))
+            if isinstance(recorder, type):
+                recorder = recorder()
+            phase_finished.connect(recorder.receive, weak=False)
+        _connected = True
+    finally:
+        _connected_lock.release()
+
+
+@contextmanager
+def timed(service, phase):
+    """
+    Times the enclosed block as a phase of a service's authentication
+    workflow and sends ``phase_finished`` when it ends::
+
+        with timed('twitter', 'token_exchange') as timing:
+            ...
+
+    """
+    connect_recorders()
+    timing = Timing(service, phase)
+    start = time.time()
+    try:
+        yield timing
+    except:
+        timing.outcome = 'error'
+        raise
+    finally:
+        phase_finished.send(sender=service, phase=phase, duration=time.time() - start,
+            outcome=timing.outcome or 'ok')
+
+
+class Recorder(object):
+    """
+    A base recorder. Subclasses implement ``record()``, which is called for
+    every phase that finishes once the recorder is listed in the
+    ``SOCIAL_REGISTRATION_RECORDERS`` setting.
+
+    """
+    def receive(self, sender, phase, duration, outcome, **kwargs):
+        self.record(sender, phase, duration, outcome)
+
+    def record(self, service, phase, duration, outcome):
+        raise NotImplementedError('This method must be set by a subclass.')
+
+
+class LoggingRecorder(Recorder):
+    """
+    Logs every phase, at info level, to the
+    ``social_registration.instrumentation`` logger.
+
+    """
+    def record(self, service, phase, duration, outcome):
+        logger.info('%s %s finished in %.1fms (%s).', service, phase, duration * 1000, outcome)
+
+
+class HistogramRecorder(Recorder):
+    """
+    Aggregates the durations of each phase, per service, into histograms
+    with fixed bucket boundaries (in milliseconds), counting outcomes as it
+    goes. Memory use does not grow with the number of logins.
+
+    """
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, service, phase, duration, outcome):
+        milliseconds = duration * 1000
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get((service, phase))
+            if histogram is None:
+                histogram = self.histograms[(service, phase)] = {
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'max': 0.0,
+                    'outcomes': {},
+                    'total': 0.0
+                }
+            for i, bound in enumerate(self.buckets):
+                if milliseconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            histogram['counts'][i] += 1
+            histogram['max'] = max(histogram['max'], milliseconds)
+            histogram['outcomes'][outcome] = histogram['outcomes'].get(outcome, 0) + 1
+            histogram['total'] += milliseconds
+        finally:
+            self.lock.release()
+
+    def percentile(self, counts, fraction, maximum):
+        """
+        Estimate a percentile as the upper bound of the bucket it falls in.
+
+        """
+        target = fraction * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return i < len(self.buckets) and min(self.buckets[i], maximum) or maximum
+        return 0.0
+
+    def stats(self):
+        """
+        Return, for each ``(service, phase)``, the number of times it ran,
+        its mean, maximum and estimated 50th, 95th and 99th percentile
+        durations in milliseconds, its outcomes and the bucket counts.
+
+        """
+        self.lock.acquire()
+        try:
+            stats = {}
+            for key, histogram in self.histograms.items():
+                count = sum(histogram['counts'])
+                stats[key] = {
+                    'buckets': zip(self.buckets + (None,), histogram['counts']),
+                    'count': count,
+                    'max': histogram['max'],
+                    'mean': histogram['total'] / count,
+                    'outcomes': dict(histogram['outcomes']),
+                    'p50': self.percentile(histogram['counts'], 0.5, histogram['max']),
+                    'p95': self.percentile(histogram['counts'], 0.95, histogram['max']),
+                    'p99': self.percentile(histogram['counts'], 0.99, histogram['max'])
+                }
+            return stats
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+
+# A process-wide aggregator; list
+# ``'social_registration.instrumentation.histograms'`` in the
+# ``SOCIAL_REGISTRATION_RECORDERS`` setting and read it with
+# ``histograms.stats()``.
+histograms = HistogramRecorder()
+
@@ -0,0 +1,136 @@
+import csv
+import json
+import os
+import sys
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+
+from social_registration.models import Association
+
+
+# The columns of an export, in order, as ``values_list()`` names them.
+# ``user`` is the user's primary key. Access tokens are live credentials, so
+# ``TOKEN_FIELDS`` are only exported when asked for.
+FIELDS = ('service', 'identifier', 'user', 'user__username', 'expires_at', 'avatar', 'profile_url',
+    'is_active', 'is_token_valid')
+TOKEN_FIELDS = ('access_token', 'access_token_secret')
+
+
+def get_column(field):
+    return field.replace('user__', '')
+
+
+def get_format(path, format):
+    """
+    Return the format to use for a file: the one given, or else CSV for a
+    ``.csv`` file and JSON lines for anything else.
+
+    """
+    format = format or (path and path.lower().endswith('.csv') and 'csv' or 'jsonl')
+    if format not in ('csv', 'jsonl'):
+        raise CommandError('Unknown format: %s' % format)
+    return format
+
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = ('Streams every association, in primary key order, to a file (or the standard '
+        'output) as JSON lines or CSV, with a header.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+            help='jsonl or csv (default: csv for a .csv file, jsonl otherwise).'),
+        make_option('--service', action='append', dest='services', default=[],
+            help='Only export associations with this service. May be given more than once.'),
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=10000,
+            help='The number of associations to read at a time.'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+            help='A file recording progress, read on start so an interrupted export resumes.'),
+        make_option('--include-tokens', action='store_true', dest='include_tokens', default=False,
+            help='Also export access tokens and secrets, which are live credentials.'),
+    )
+
+    def handle(self, *args, **options):
+        path = args and args[0] or None
+        format = get_format(path, options['format'])
+        checkpoint = options['checkpoint']
+        self.fields = FIELDS + (options['include_tokens'] and TOKEN_FIELDS or ())
+        self.columns = [get_column(field) for field in self.fields]
+        if checkpoint and not path:
+            raise CommandError('An export to the standard output cannot be resumed.')
+
+        progress = {'last_pk': 0, 'offset': 0, 'rows': 0}
+        if checkpoint and os.path.exists(checkpoint):
+            progress = json.load(open(checkpoint))
+
+        if not path:
+            f = sys.stdout
+        elif progress['offset']:
+            # Anything written after the last checkpoint is written again.
+            f = open(path, 'r+b')
+            f.seek(progress['offset'])
+            f.truncate()
+        else:
+            f = open(path, 'wb')
+
+        queryset = Association.objects.all()
+        if options['services']:
+            queryset = queryset.filter(service__in=options['services'])
+
+        try:
+            writer = format == 'csv' and csv.writer(f) or None
+            if writer and not progress['offset']:
+                writer.writerow(self.columns)
+
+            last_pk = progress['last_pk']
+            while True:
+                # Walking the primary key keeps each query cheap however far
+                # into the table we are, and memory bounded by the batch.
+                rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', *self.fields)[:options['batch_size']])
+                reset_queries()
+                if not rows:
+                    break
+                for row in rows:
+                    self.write(f, writer, row[1:])
+                last_pk = rows[-1][0]
+                progress['rows'] += len(rows)
+
+                if checkpoint:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    progress.update(last_pk=last_pk, offset=f.tell())
+                    self.save_progress(checkpoint, progress)
+                if path:
+                    self.stdout.write('%d associations exported.\n' % progress['rows'])
+        finally:
+            if path:
+                f.close()
+
+    def write(self, f, writer, row):
+        values = dict(zip(self.columns, row))
+        if values['expires_at'] is not None:
+            values['expires_at'] = values['expires_at'].isoformat()
+        if writer is None:
+            f.write(json.dumps(values, sort_keys=True))
+            f.write('\n')
+            return
+        columns = []
+        for column in self.columns:
+            value = values[column]
+            if isinstance(value, bool):
+                value = int(value)
+            elif value is None:
+                value = ''
+            columns.append(unicode(value).encode('utf-8'))
+        writer.writerow(columns)
+
+    def save_progress(self, checkpoint, progress):
+        f = open('%s.tmp' % checkpoint, 'w')
+        try:
+            json.dump(progress, f)
+        finally:
+            f.close()
+        os.rename('%s.tmp' % checkpoint, checkpoint)
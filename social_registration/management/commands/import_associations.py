@@ -0,0 +1,243 @@
+import csv
+import json
+import os
+import time
+
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections, reset_queries, transaction
+from django.utils.dateparse import parse_datetime
+
+from social_registration.cache import association_cache
+from social_registration.management.commands.export_associations import get_format
+from social_registration.management.commands.refresh_social_profiles import bulk_update
+from social_registration.models import Association
+
+
+# The columns an import may set besides ``service``, ``identifier`` and the
+# user. Those a file leaves out keep their defaults, or current values.
+FIELDS = ('access_token', 'access_token_secret', 'avatar', 'expires_at', 'is_active', 'is_token_valid',
+    'profile_url')
+
+
+def chunked(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Streams associations in from a file written by export_associations (JSON lines '
+        'or CSV), creating those that are new and updating those that exist for the same '
+        'service and identifier.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+            help='jsonl or csv (default: csv for a .csv file, jsonl otherwise).'),
+        make_option('--match', action='store', dest='match', default='username',
+            help='Find users by "username" (default) or by primary key ("user").'),
+        make_option('--no-update', action='store_false', dest='update', default=True,
+            help='Leave associations that already exist as they are.'),
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=1000,
+            help='The number of associations to write at a time.'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+            help='A file recording progress, read on start so an interrupted import resumes.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the file to import.')
+        if options['match'] not in ('user', 'username'):
+            raise CommandError('Unknown --match: %s' % options['match'])
+        path = args[0]
+        format = get_format(path, options['format'])
+        checkpoint = options['checkpoint']
+        self.match = options['match']
+        self.update = options['update']
+        self.verbosity = int(options['verbosity'])
+
+        # SQLite allows at most 999 parameters in a query.
+        self.chunk_size = options['batch_size']
+        if connections[Association.objects.db].vendor == 'sqlite':
+            self.chunk_size = min(self.chunk_size, 999 // len(Association._meta.fields))
+
+        progress = {'created': 0, 'offset': 0, 'read': 0, 'skipped': 0, 'unchanged': 0, 'updated': 0}
+        if checkpoint and os.path.exists(checkpoint):
+            progress = json.load(open(checkpoint))
+
+        f = open(path, 'rb')
+        self.start, self.start_read = time.time(), progress['read']
+        try:
+            batch = []
+            for record, offset in self.read(f, format, progress['offset']):
+                batch.append(record)
+                if len(batch) < options['batch_size']:
+                    continue
+                self.process(batch, offset, progress, checkpoint)
+                batch = []
+            if batch:
+                self.process(batch, offset, progress, checkpoint)
+        finally:
+            f.close()
+
+    def read(self, f, format, offset):
+        """
+        Yields each record of a file from ``offset``, as a dictionary, with
+        the offset of the record that follows it. A CSV file's header is
+        always read first.
+
+        """
+        if format == 'csv':
+            # Lines are read one at a time so that the file's position is
+            # that of the next record.
+            reader = csv.reader(iter(f.readline, ''))
+            header = reader.next()
+            if offset:
+                f.seek(offset)
+            for row in reader:
+                yield dict(zip(header, [value.decode('utf-8') for value in row])), f.tell()
+        else:
+            f.seek(offset)
+            for line in iter(f.readline, ''):
+                if line.strip():
+                    yield json.loads(line), f.tell()
+
+    def clean(self, record):
+        """
+        Returns the service, identifier, user and other fields of a record,
+        or raises ``ValueError`` if it cannot be imported.
+
+        """
+        service = record.get('service')
+        if service not in dict(Association.SERVICE_CHOICES):
+            raise ValueError('Unknown service: %r' % service)
+        try:
+            identifier = int(record.get('identifier'))
+        except (TypeError, ValueError):
+            raise ValueError('Invalid identifier: %r' % record.get('identifier'))
+        user = record.get(self.match)
+        if user in (None, ''):
+            raise ValueError('No %s.' % self.match)
+
+        fields = {}
+        for name in FIELDS:
+            if name not in record:
+                continue
+            value = record[name]
+            if name == 'expires_at':
+                if value:
+                    value = parse_datetime(value)
+                    if value is None:
+                        raise ValueError('Invalid expires_at: %r' % record[name])
+                else:
+                    value = None
+            elif name in ('is_active', 'is_token_valid'):
+                if isinstance(value, basestring):
+                    value = value.lower() in ('1', 't', 'true')
+                value = bool(value)
+            else:
+                value = value or ''
+            fields[name] = value
+        return service, identifier, user, fields
+
+    def process(self, batch, offset, progress, checkpoint):
+        records = {}
+        for record in batch:
+            try:
+                service, identifier, user, fields = self.clean(record)
+            except ValueError, e:
+                self.skip(progress, record, e)
+                continue
+            # The last record for an association wins.
+            records[(service, identifier)] = (record, user, fields)
+
+        try:
+            counts = self.save(records)
+        except IntegrityError:
+            # An association was created, e.g. by a login, since the batch
+            # looked for it.
+            counts = self.save(records)
+        reset_queries()
+
+        for record in counts.pop('missing'):
+            self.skip(progress, record, 'No such user.')
+        for key, count in counts.items():
+            progress[key] += count
+        progress['offset'] = offset
+        progress['read'] += len(batch)
+        if checkpoint:
+            self.save_progress(checkpoint, progress)
+        self.stdout.write('%d read, %d created, %d updated, %d unchanged, %d skipped (%.0f per second).\n' % (
+            progress['read'], progress['created'], progress['updated'], progress['unchanged'],
+            progress['skipped'], (progress['read'] - self.start_read) / max(time.time() - self.start, 0.001)))
+
+    @transaction.commit_on_success
+    def save(self, records):
+        """
+        Creates or updates the associations of a batch with as few queries
+        as possible, returning how many were created, updated and left
+        unchanged, and the records whose user could not be found.
+
+        """
+        counts = {'created': 0, 'missing': [], 'unchanged': 0, 'updated': 0}
+
+        users = {}
+        keys = list(set([user for record, user, fields in records.values()]))
+        for chunk in chunked(keys, self.chunk_size):
+            if self.match == 'username':
+                users.update(User.objects.filter(username__in=chunk).values_list('username', 'pk'))
+            else:
+                for pk in User.objects.filter(pk__in=chunk).values_list('pk', flat=True):
+                    users[str(pk)] = users[pk] = pk
+
+        existing = {}
+        for service in set([service for service, identifier in records]):
+            identifiers = [identifier for key, identifier in records if key == service]
+            for chunk in chunked(identifiers, self.chunk_size):
+                for row in (Association.objects.filter(identifier__in=chunk, service=service)
+                        .values('pk', 'identifier', 'user', *FIELDS)):
+                    existing[(service, row['identifier'])] = row
+
+        created, updated, stale = [], [], []
+        # In key order, so that concurrent imports lock rows in the same order.
+        for (service, identifier), (record, user, fields) in sorted(records.items()):
+            user = users.get(user)
+            if user is None:
+                counts['missing'].append(record)
+                continue
+            row = existing.get((service, identifier))
+            if row is None:
+                created.append(Association(identifier=identifier, service=service, user_id=user, **fields))
+                continue
+            changes = dict([(name, value) for name, value in dict(fields, user=user).items() if row[name] != value])
+            if not self.update or not changes:
+                counts['unchanged'] += 1
+                continue
+            updated.append((row['pk'], changes))
+            # Only a new user or ``is_active`` makes the cached user stale.
+            if 'user' in changes or 'is_active' in changes:
+                stale.append((service, identifier))
+
+        bulk_update(Association, updated, Association.objects.db)
+        counts['updated'] = len(updated)
+        for chunk in chunked(created, self.chunk_size):
+            Association.objects.bulk_create(chunk)
+        counts['created'] = len(created)
+        # Writing in bulk skips the signal that keeps the cache fresh.
+        for service, identifier in stale:
+            association_cache.delete(service, identifier)
+        return counts
+
+    def skip(self, progress, record, reason):
+        progress['skipped'] += 1
+        if self.verbosity > 1:
+            self.stderr.write('Skipped %s: %s\n' % (json.dumps(record, sort_keys=True), reason))
+
+    def save_progress(self, checkpoint, progress):
+        f = open('%s.tmp' % checkpoint, 'w')
+        try:
+            json.dump(progress, f)
+        finally:
+            f.close()
+        os.rename('%s.tmp' % checkpoint, checkpoint)
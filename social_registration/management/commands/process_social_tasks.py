@@ -0,0 +1,31 @@
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from social_registration.tasks import DatabaseExecutor, get_executor
+
+
+class Command(BaseCommand):
+    help = 'Runs deferred social_registration tasks queued in the database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', action='store', dest='limit', type='int', default=100,
+            help='The maximum number of tasks to run per batch.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep polling for new tasks instead of exiting once the queue is drained.'),
+        make_option('--interval', action='store', dest='interval', type='float', default=5,
+            help='Seconds to wait between polls when --loop is given.'),
+    )
+
+    def handle(self, *args, **options):
+        executor = get_executor()
+        if not isinstance(executor, DatabaseExecutor):
+            raise CommandError('SOCIAL_REGISTRATION_TASK_EXECUTOR must be set to the DatabaseExecutor.')
+        while True:
+            while executor.run_pending(options['limit']):
+                pass
+            self.stdout.write('%(completed)d completed, %(retried)d retried, %(failed)d failed, %(depth)d queued.\n' % executor.stats())
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
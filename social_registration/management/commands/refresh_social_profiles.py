@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from social_registration.backends import get_backend
+from social_registration.exceptions import ProviderError, RateLimited
+from social_registration.models import Association
+
+
+logger = logging.getLogger('social_registration.commands')
+
+
+def update_rows(model, rows, connection):
+    quote = connection.ops.quote_name
+    pk_column = quote(model._meta.pk.column)
+    columns, params = [], []
+    for name in sorted(set([name for pk, fields in rows for name in fields])):
+        field = model._meta.get_field(name)
+        cases = []
+        for pk, fields in rows:
+            if name in fields:
+                cases.append('WHEN %s THEN %s')
+                params.extend([pk, field.get_db_prep_save(fields[name], connection=connection)])
+        columns.append('%s = CASE %s %s ELSE %s END' % (quote(field.column), pk_column, ' '.join(cases),
+            quote(field.column)))
+    params.extend([pk for pk, fields in rows])
+    connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (quote(model._meta.db_table),
+        ', '.join(columns), pk_column, ', '.join(['%s'] * len(rows))), params)
+
+
+def update_rows_from_values(model, rows, connection):
+    """
+    PostgreSQL's form of ``update_rows()``, joining the table to a ``VALUES``
+    list. Rows that change different fields are written by one statement
+    for each set of fields.
+
+    """
+    quote = connection.ops.quote_name
+    table, pk_column = quote(model._meta.db_table), quote(model._meta.pk.column)
+    groups = {}
+    for pk, fields in rows:
+        groups.setdefault(tuple(sorted(fields)), []).append((pk, fields))
+    for names, group in sorted(groups.items()):
+        fields = [model._meta.get_field(name) for name in names]
+        params = []
+        for pk, values in group:
+            params.append(pk)
+            params.extend([field.get_db_prep_save(values[field.name], connection=connection) for field in fields])
+        row = '(%s)' % ', '.join(['%s'] * (len(fields) + 1))
+        # The values of a VALUES list have no column type to go by.
+        columns = ['%s = CAST(v.%s AS %s)' % (quote(field.column), quote(field.column), field.db_type(connection))
+            for field in fields]
+        connection.cursor().execute('UPDATE %s SET %s FROM (VALUES %s) AS v (%s) WHERE %s.%s = v.%s' % (table,
+            ', '.join(columns), ', '.join([row] * len(group)),
+            ', '.join([pk_column] + [quote(field.column) for field in fields]), table, pk_column, pk_column), params)
+
+
+def bulk_update(model, changes, using='default'):
+    """
+    Writes ``changes``, a list of ``(pk, fields)`` pairs, to the rows of
+    ``model`` with as few ``UPDATE`` statements as the database's limit on
+    query parameters allows, each column taking its new value from a
+    ``CASE`` on the primary key (or, on PostgreSQL, from a ``VALUES`` list).
+    Rows may change different fields; those a row leaves out keep their
+    value.
+
+    """
+    connection = connections[using]
+    update = connection.vendor == 'postgresql' and update_rows_from_values or update_rows
+    # SQLite allows at most 999 parameters in a query. A row takes two for
+    # each field it changes and one to be selected.
+    max_params = connection.vendor == 'sqlite' and 999 or 30000
+    rows, params = [], 0
+    for pk, fields in changes:
+        if rows and params + 2 * len(fields) + 1 > max_params:
+            update(model, rows, connection)
+            rows, params = [], 0
+        rows.append((pk, fields))
+        params += 2 * len(fields) + 1
+    if rows:
+        update(model, rows, connection)
+    transaction.commit_unless_managed(using=using)
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls made from any number of threads so that no more than
+    ``rate`` are started per second.
+
+    """
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Command(BaseCommand):
+    help = ('Refreshes the avatars and profile URLs of active associations using '
+        'the batch endpoints of each service.')
+    option_list = BaseCommand.option_list + (
+        make_option('--service', action='append', dest='services', default=[],
+            help='Only refresh associations with this service. May be given more than once.'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+            help='A file recording progress, read on start so an interrupted run resumes.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=4,
+            help='The number of batch calls to make concurrently.'),
+        make_option('--rate', action='store', dest='rate', type='float', default=5,
+            help='The maximum number of batch calls to start per second (0 for no limit).'),
+        make_option('--attempts', action='store', dest='attempts', type='int', default=3,
+            help='The number of times to try a batch call that fails for a reason other than the rate limit.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report what would change without writing anything.'),
+    )
+
+    def handle(self, *args, **options):
+        services = options['services'] or [service for service, name in Association.SERVICE_CHOICES]
+        self.attempts = options['attempts']
+        self.checkpoint = options['checkpoint']
+        self.dry_run = options['dry_run']
+        self.limiter = RateLimiter(options['rate'])
+        self.pool = ThreadPool(options['workers'])
+        self.workers = options['workers']
+
+        self.progress = {}
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            self.progress = json.load(open(self.checkpoint))
+
+        try:
+            for service in services:
+                self.refresh(service)
+        finally:
+            self.pool.close()
+
+    def refresh(self, service):
+        backend = get_backend('social_registration.backends.%s.AccountBackend' % service)
+        if not hasattr(backend, 'fetch_profiles'):
+            raise CommandError('The %s backend cannot fetch profiles in bulk.' % service)
+
+        def fetch(chunk):
+            """
+            Fetch the profiles of a chunk, waiting out the rate limit as
+            often as it takes and retrying other failures, with a growing
+            delay, up to ``attempts`` times. Returns ``None`` if the chunk
+            could not be fetched.
+
+            """
+            identifiers = [identifier for pk, identifier, avatar, profile_url in chunk]
+            attempt = 1
+            while True:
+                self.limiter.wait()
+                try:
+                    # A bulk refresh would push the profiles of logins out of
+                    # the shared cache.
+                    return backend.fetch_profiles(identifiers, cache=False)
+                except RateLimited, e:
+                    time.sleep(e.retry_after or 60)
+                except ProviderError, e:
+                    if attempt >= self.attempts:
+                        logger.warning('Giving up on %d %s profiles: %s', len(chunk), service, e)
+                        return None
+                    time.sleep(2 ** attempt)
+                    attempt += 1
+
+        last_pk = done_pk = self.progress.get(service, 0)
+        seen = changed = failed = 0
+        while True:
+            # Read as many chunks as there are workers, walking the primary key
+            # so that each query stays cheap however far into the table we are.
+            chunks = []
+            for i in range(self.workers):
+                chunk = list(Association.objects.filter(is_active=True, service=service, pk__gt=last_pk)
+                    .order_by('pk').values_list('pk', 'identifier', 'avatar', 'profile_url')[:backend.batch_size])
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                last_pk = chunk[-1][0]
+            if not chunks:
+                break
+
+            for chunk, profiles in zip(chunks, self.pool.map(fetch, chunks)):
+                seen += len(chunk)
+                if profiles is None:
+                    failed += len(chunk)
+                    continue
+                changed += self.write(backend, chunk, profiles)
+                # The checkpoint stops before the first chunk that failed, so
+                # that a resumed run tries it again.
+                if not failed:
+                    done_pk = chunk[-1][0]
+
+            self.save_progress(service, done_pk)
+            self.stdout.write('%s: %d checked, %d changed, %d failed.\n' % (service, seen, changed, failed))
+
+    def write(self, backend, chunk, profiles):
+        """
+        Updates the associations in a chunk whose fields differ from their
+        fetched profile, returning how many did.
+
+        """
+        changes = []
+        for pk, identifier, avatar, profile_url in chunk:
+            profile = profiles.get(str(identifier))
+            if profile is None:
+                continue
+            fields = backend.get_association_fields(profile)
+            if fields != {'avatar': avatar, 'profile_url': profile_url}:
+                changes.append((pk, fields))
+
+        if changes and not self.dry_run:
+            self.apply(changes)
+        return len(changes)
+
+    @transaction.commit_on_success
+    def apply(self, changes):
+        bulk_update(Association, changes, Association.objects.db)
+
+    def save_progress(self, service, last_pk):
+        self.progress[service] = last_pk
+        if self.checkpoint and not self.dry_run:
+            f = open('%s.tmp' % self.checkpoint, 'w')
+            try:
+                json.dump(self.progress, f)
+            finally:
+                f.close()
+            os.rename('%s.tmp' % self.checkpoint, self.checkpoint)
+
@@ -0,0 +1,123 @@
+import datetime
+import operator
+
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from social_registration.backends import get_backend
+from social_registration.exceptions import InvalidToken, ProviderError
+from social_registration.management.commands.refresh_social_profiles import RateLimiter
+from social_registration.models import Association
+
+
+class Command(BaseCommand):
+    help = ('Renews the access tokens of active associations that expire soonest, '
+        'marking those the service will not renew. Meant to be run regularly, '
+        'e.g. from cron, so that no login has to repair a token.')
+    option_list = BaseCommand.option_list + (
+        make_option('--service', action='append', dest='services', default=[],
+            help='Only renew tokens of this service (default: facebook). May be given more than once.'),
+        make_option('--days', action='store', dest='days', type='float', default=7,
+            help='Renew tokens that expire within this many days.'),
+        make_option('--limit', action='store', dest='limit', type='int', default=0,
+            help='Renew at most this many tokens per service (0 for no limit).'),
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=100,
+            help='The number of tokens to read, renew and write at a time.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=4,
+            help='The number of tokens to renew concurrently.'),
+        make_option('--rate', action='store', dest='rate', type='float', default=10,
+            help='The maximum number of renewals to start per second (0 for no limit).'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report which tokens would be renewed without renewing them.'),
+    )
+
+    def handle(self, *args, **options):
+        services = options['services'] or ['facebook']
+        self.batch_size = options['batch_size']
+        self.dry_run = options['dry_run']
+        self.horizon = timezone.now() + datetime.timedelta(days=options['days'])
+        self.limit = options['limit']
+        self.limiter = RateLimiter(options['rate'])
+        self.pool = ThreadPool(options['workers'])
+
+        try:
+            for service in services:
+                self.refresh(service)
+        finally:
+            self.pool.close()
+
+    def refresh(self, service):
+        backend = get_backend('social_registration.backends.%s.AccountBackend' % service)
+        if not hasattr(backend, 'exchange_token'):
+            raise CommandError('The %s backend cannot renew access tokens.' % service)
+
+        def exchange(row):
+            pk, access_token, expires_at = row
+            if self.dry_run:
+                return pk, None, None
+            self.limiter.wait()
+            try:
+                return pk, backend.exchange_token(access_token), None
+            except ProviderError, e:
+                return pk, None, e
+
+        # The index on ``expires_at`` serves as a priority queue: the tokens
+        # expiring soonest come first, and each batch continues from the
+        # last one read, so that those that failed for now are not read
+        # again in this run.
+        queryset = (Association.objects.filter(expires_at__lte=self.horizon, is_active=True, is_token_valid=True,
+            service=service).order_by('expires_at', 'pk'))
+        last = None
+        seen = renewed = invalid = failed = superseded = 0
+        while not self.limit or seen < self.limit:
+            batch = queryset
+            if last is not None:
+                batch = batch.filter(Q(expires_at__gt=last[0]) | Q(expires_at=last[0], pk__gt=last[1]))
+            size = self.limit and min(self.batch_size, self.limit - seen) or self.batch_size
+            rows = list(batch.values_list('pk', 'access_token', 'expires_at')[:size])
+            if not rows:
+                break
+            last = (rows[-1][2], rows[-1][0])
+
+            read = dict([(pk, access_token) for pk, access_token, expires_at in rows])
+            tokens, rejected = [], []
+            for pk, token, error in self.pool.map(exchange, rows):
+                if token is not None:
+                    tokens.append((pk, read[pk], token))
+                elif isinstance(error, InvalidToken):
+                    rejected.append((pk, read[pk]))
+                elif error is not None:
+                    failed += 1
+            if not self.dry_run:
+                written, marked = self.apply(tokens, rejected)
+                superseded += len(tokens) - written + len(rejected) - marked
+                renewed += written
+                invalid += marked
+
+            seen += len(rows)
+            self.stdout.write('%s: %d checked, %d renewed, %d invalid, %d failed, %d superseded (next expiry %s).\n' % (
+                service, seen, renewed, invalid, failed, superseded, rows[-1][2]))
+
+    @transaction.commit_on_success
+    def apply(self, tokens, rejected):
+        """
+        Stores renewed tokens and marks rejected ones, returning how many of
+        each were written. A token is only written if the association still
+        holds the one that was read: a user who logged in meanwhile has a
+        newer token, which is left alone.
+
+        """
+        written = 0
+        for pk, old_token, (access_token, expires_at) in tokens:
+            written += Association.objects.filter(access_token=old_token, pk=pk).update(
+                access_token=access_token, expires_at=expires_at)
+        marked = 0
+        if rejected:
+            marked = Association.objects.filter(reduce(operator.or_,
+                [Q(access_token=old_token, pk=pk) for pk, old_token in rejected])).update(is_token_valid=False)
+        return written, marked
@@ -0,0 +1,48 @@
+import logging
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from social_registration.queries import QueryLog
+
+
+logger = logging.getLogger('social_registration.queries')
+
+
+class QueryBudgetMiddleware(object):
+    """
+    In development (i.e., with ``DEBUG`` on) records the queries made by each
+    request, adds their number to the response as an ``X-Query-Count``
+    header and logs a warning for any view that repeats a query or makes
+    more queries than its budget in the ``SOCIAL_REGISTRATION_VIEW_QUERY_BUDGETS``
+    setting, a dictionary keyed by the view's dotted path.
+
+    List it first in ``MIDDLEWARE_CLASSES`` so that the queries of the other
+    middleware (e.g., loading and saving the session) are counted too.
+
+    """
+    def __init__(self):
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed
+        self.budgets = getattr(settings, 'SOCIAL_REGISTRATION_VIEW_QUERY_BUDGETS', {})
+
+    def process_request(self, request):
+        request.query_log = QueryLog()
+        request.query_log.__enter__()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, 'query_log'):
+            request.query_log.view = '%s.%s' % (view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        log = getattr(request, 'query_log', None)
+        if log is None:
+            return response
+        log.__exit__(None, None, None)
+        view = getattr(log, 'view', request.path)
+        report = log.report(view, self.budgets.get(view))
+        if report:
+            logger.warning(report)
+        response['X-Query-Count'] = str(log.count)
+        return response
+
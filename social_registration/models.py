@@ -1,5 +1,12 @@
 from django.contrib.auth import authenticate
+from django.contrib.auth.models import User, update_last_login
+from django.contrib.auth.signals import user_logged_in
 from django.db import models
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils import timezone
+
+from social_registration.cache import association_cache
+from social_registration.usernames import username_index
 
 
 class Association(models.Model):
@@ -8,6 +15,11 @@ class Association(models.Model):
     they have chosen to authenticate with the given service, either during
     registration or after the fact.
 
+    Facebook's access tokens expire at ``expires_at`` and are renewed ahead of
+    it by the ``refresh_social_tokens`` command; Twitter's do not expire. A
+    token that could not be renewed is marked with ``is_token_valid`` until
+    the user next logs in.
+
     """
     SERVICE_CHOICES = (
         ('facebook', 'Facebook'),
@@ -16,17 +28,134 @@ class Association(models.Model):
 
     user = models.ForeignKey('auth.User')
     service = models.CharField(choices=SERVICE_CHOICES, max_length=10)
-    identifier = models.PositiveIntegerField()
+    identifier = models.PositiveIntegerField(db_index=True)
     access_token = models.CharField(blank=True, max_length=255)
+    access_token_secret = models.CharField(blank=True, max_length=255)
+    expires_at = models.DateTimeField(blank=True, db_index=True, null=True)
+    is_token_valid = models.BooleanField(default=True)
     avatar = models.CharField(blank=True, max_length=255)
     profile_url = models.URLField(verify_exists=True)
-    is_active = models.BooleanField(default=True)
+    is_active = models.BooleanField(db_index=True, default=True)
+
+    class Meta:
+        unique_together = (('service', 'identifier'),)
 
     def __unicode__(self):
         return u'%s: %s' % (self.user, self.identifier)
 
     def authenticate(self):
         if self.is_active:
-            return authenticate(identifier=self.identifier)
+            return authenticate(service=self.service, identifier=self.identifier)
+
+
+class Task(models.Model):
+    """
+    A unit of deferred work queued by ``social_registration.tasks`` when the
+    ``DatabaseExecutor`` is in use: the dotted path of a function and the
+    JSON-encoded arguments to call it with.
+
+    """
+    path = models.CharField(max_length=255)
+    arguments = models.TextField()
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(db_index=True, default=timezone.now)
+    is_failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'%s (%d attempts)' % (self.path, self.attempts)
+
+
+def get_cached_fields(instance):
+    return (instance.service, instance.identifier, instance.user_id, instance.is_active)
+
+
+def track_association(sender, instance, **kwargs):
+    """
+    Remembers the fields of an ``Association`` that decide which user, if
+    any, the association cache holds for it, as they were loaded.
+
+    """
+    instance._cached_fields = get_cached_fields(instance)
+
+
+def invalidate_association(sender, instance, **kwargs):
+    """
+    Drops the cached user for an ``Association`` when it is deleted.
+
+    """
+    association_cache.delete(instance.service, instance.identifier)
+
+
+def invalidate_changed_association(sender, instance, created, **kwargs):
+    """
+    Drops the cached user for a saved ``Association`` if its service,
+    identifier, user or ``is_active`` changed. Saving its tokens or profile
+    leaves the cached user in place.
+
+    """
+    previous, instance._cached_fields = instance._cached_fields, get_cached_fields(instance)
+    if created or previous == instance._cached_fields:
+        return
+    association_cache.delete(instance.service, instance.identifier)
+    if previous[:2] != instance._cached_fields[:2]:
+        association_cache.delete(*previous[:2])
+
+
+def invalidate_user_associations(sender, instance, created=False, **kwargs):
+    """
+    Drops the cached copies of a ``User`` held for each of its associations
+    whenever the user is saved or deleted. A new user has none.
+
+    """
+    if created or not association_cache.enabled:
+        return
+    for service, identifier in Association.objects.filter(user=instance).values_list('service', 'identifier'):
+        association_cache.delete(service, identifier)
+
+
+def index_username(sender, instance, **kwargs):
+    """
+    Adds the username of a saved ``User`` to the in-process username index.
+
+    """
+    username_index.add(instance.username)
+
+
+def record_last_login(sender, user, **kwargs):
+    """
+    Writes only the ``last_login`` of a user who logged in through one of the
+    ``AuthenticationBackend`` subclasses: saving the whole user would drop
+    its cached copies on every login, and cost a query to find them. Any
+    other login is left to ``django.contrib.auth.models.update_last_login``.
+
+    """
+    if getattr(user, 'social_association_id', None) is None:
+        return update_last_login(sender, user, **kwargs)
+    user.last_login = timezone.now()
+    User.objects.filter(pk=user.pk).update(last_login=user.last_login)
+
+
+def connect_last_login(enabled):
+    """
+    Connects ``record_last_login()`` in place of Django's ``last_login``
+    receiver when ``enabled``, as it is while the association cache is on,
+    or restores Django's.
+
+    """
+    if enabled:
+        user_logged_in.disconnect(update_last_login)
+        user_logged_in.connect(record_last_login)
+    else:
+        user_logged_in.disconnect(record_last_login)
+        user_logged_in.connect(update_last_login)
+
 
+post_init.connect(track_association, sender=Association)
+post_save.connect(invalidate_changed_association, sender=Association)
+post_delete.connect(invalidate_association, sender=Association)
+post_save.connect(invalidate_user_associations, sender=User)
+post_delete.connect(invalidate_user_associations, sender=User)
+post_save.connect(index_username, sender=User)
+connect_last_login(association_cache.enabled)
 
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger('social_registration.profiles')
+
+
+class Call(object):
+    """
+    An upstream fetch in progress, shared by every thread asking for the same
+    profile while it runs.
+
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+        self.result = None
+
+
+class ProfileCache(object):
+    """
+    Caches the profiles fetched from external services, keyed by
+    ``(service, identifier)``, in Django's cache framework.
+
+    A profile is fresh for ``timeout`` seconds. After that, and until
+    ``stale_timeout`` seconds have passed, the stale copy is still returned
+    while a single background refresh replaces it. Concurrent requests for a
+    profile that is not cached at all are coalesced within the process into
+    one upstream call.
+
+    """
+    def __init__(self, timeout=3600, stale_timeout=86400):
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def key(self, service, identifier):
+        return 'social_registration:profile:%s:%s' % (service, identifier)
+
+    def get(self, service, identifier, fetch):
+        """
+        Return the profile for the given service and identifier, calling
+        ``fetch()`` to retrieve it when it is missing or stale.
+
+        """
+        key = self.key(service, identifier)
+        entry = cache.get(key)
+        if entry is None:
+            return self.fetch(key, fetch)
+        fetched_at, profile = entry
+        if time.time() - fetched_at > self.timeout:
+            self.revalidate(key, fetch)
+        return profile
+
+    def peek(self, service, identifier):
+        """
+        Return the cached profile for the given service and identifier,
+        however stale, or ``None`` without fetching it.
+
+        """
+        entry = cache.get(self.key(service, identifier))
+        return entry and entry[1]
+
+    def set(self, service, identifier, profile):
+        self.store(self.key(service, identifier), profile)
+
+    def delete(self, service, identifier):
+        cache.delete(self.key(service, identifier))
+
+    def store(self, key, profile):
+        cache.set(key, (time.time(), profile), self.stale_timeout)
+
+    def fetch(self, key, fetch):
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        finally:
+            self.lock.release()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            try:
+                call.result = fetch()
+            except Exception, e:
+                call.error = e
+                raise
+            self.store(key, call.result)
+            return call.result
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call.event.set()
+
+    def revalidate(self, key, fetch):
+        """
+        Refresh a stale profile in a background thread, unless a refresh is
+        already running in this or (as far as the cache can tell) any other
+        process.
+
+        """
+        if key in self.calls or not cache.add('%s:refresh' % key, True, 60):
+            return
+
+        def refresh():
+            try:
+                self.fetch(key, fetch)
+            except Exception:
+                logger.exception('Failed to refresh %s.', key)
+            cache.delete('%s:refresh' % key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+
+profile_cache = ProfileCache(
+    timeout=getattr(settings, 'SOCIAL_REGISTRATION_PROFILE_TIMEOUT', 3600),
+    stale_timeout=getattr(settings, 'SOCIAL_REGISTRATION_PROFILE_STALE_TIMEOUT', 86400)
+)
+
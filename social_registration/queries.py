@@ -0,0 +1,157 @@
+import logging
+import re
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from social_registration.exceptions import QueryBudgetExceeded
+
+
+logger = logging.getLogger('social_registration.queries')
+
+# The most queries each step of a workflow should make on Django 1.4,
+# including those made by ``login()`` and the session while it runs, with
+# the ``DatabaseExecutor`` queuing deferred work. Override them with the
+# ``SOCIAL_REGISTRATION_QUERY_BUDGETS`` setting.
+DEFAULT_QUERY_BUDGETS = {
+    'authenticate': 2,
+    'create': 1,
+    'deauthenticate': 2,
+    'grant': 8,
+    'link': 3,
+    'register': 3,
+}
+
+# Whether ``query_budget()`` does nothing (``None``), logs a warning
+# (``'warn'``) or raises ``QueryBudgetExceeded`` (``'raise'``) when a step
+# goes over its budget or repeats a query.
+budget_mode = getattr(settings, 'SOCIAL_REGISTRATION_QUERY_BUDGET_MODE', None)
+
+
+def get_budget(name):
+    return getattr(settings, 'SOCIAL_REGISTRATION_QUERY_BUDGETS', {}).get(name, DEFAULT_QUERY_BUDGETS.get(name))
+
+
+def get_shape(sql):
+    """
+    Return a query with its literal values replaced by ``?``, so that the
+    queries of an N+1 pattern, which differ only in their values, compare
+    equal.
+
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\(\?(?:, \?)*\)', '(?)', sql)
+
+
+class QueryLog(object):
+    """
+    Collects the queries run on a database connection, by the current thread,
+    while used as a context manager, whether or not ``DEBUG`` is on.
+
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.queries = []
+
+    def __enter__(self):
+        self.use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.use_debug_cursor = self.use_debug_cursor
+        self.queries = self.connection.queries[self.start:]
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def duplicates(self):
+        """
+        Return each query that was run more than once, with how many times.
+
+        """
+        counts = {}
+        for query in self.queries:
+            counts[query['sql']] = counts.get(query['sql'], 0) + 1
+        return sorted([(sql, count) for sql, count in counts.items() if count > 1])
+
+    def similar(self, threshold=3):
+        """
+        Return each query shape that was run at least ``threshold`` times with
+        different values (a likely N+1), with how many times.
+
+        """
+        counts = {}
+        for query in self.queries:
+            shape = get_shape(query['sql'])
+            counts[shape] = counts.get(shape, 0) + 1
+        return sorted([(shape, count) for shape, count in counts.items() if count >= threshold])
+
+    def report(self, name, budget=None, allow_duplicates=False):
+        """
+        Return a description of how the queries logged went over ``budget``
+        or repeated themselves, or ``None`` if they did neither.
+
+        """
+        problems = []
+        if budget is not None and self.count > budget:
+            problems.append('%d queries, over its budget of %d' % (self.count, budget))
+        if not allow_duplicates:
+            for sql, count in self.duplicates():
+                problems.append('%d identical queries: %s' % (count, sql))
+            for shape, count in self.similar():
+                problems.append('%d similar queries: %s' % (count, shape))
+        if not problems:
+            return None
+        return '%s made %s.\n%s' % (name, '; '.join(problems),
+            '\n'.join(['    %s' % query['sql'] for query in self.queries]))
+
+
+@contextmanager
+def assert_query_budget(budget, allow_duplicates=False, using=DEFAULT_DB_ALIAS):
+    """
+    Raises ``QueryBudgetExceeded`` if the enclosed block makes more than
+    ``budget`` queries (a number, or the name of a workflow step in
+    ``DEFAULT_QUERY_BUDGETS``) or, unless ``allow_duplicates`` is set,
+    repeats a query. For use in tests::
+
+        with assert_query_budget('grant'):
+            response = self.client.get(callback_url)
+
+    """
+    name = isinstance(budget, basestring) and budget or 'The block'
+    if isinstance(budget, basestring):
+        budget = get_budget(budget)
+    log = QueryLog(using)
+    with log:
+        yield log
+    report = log.report(name, budget, allow_duplicates)
+    if report:
+        raise QueryBudgetExceeded(report)
+
+
+@contextmanager
+def query_budget(name, using=DEFAULT_DB_ALIAS):
+    """
+    Checks the queries of a workflow step against its budget according to
+    ``SOCIAL_REGISTRATION_QUERY_BUDGET_MODE``. Nothing is recorded when the
+    setting is off.
+
+    """
+    if budget_mode is None:
+        yield
+        return
+    log = QueryLog(using)
+    with log:
+        yield
+    report = log.report(name, get_budget(name))
+    if report:
+        if budget_mode == 'raise':
+            raise QueryBudgetExceeded(report)
+        logger.warning(report)
+
@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache, get_cache
+
+from social_registration.exceptions import RateLimited
+
+
+# Requests allowed per (service, endpoint) as a bucket capacity and a refill
+# rate in requests per second. Endpoints not listed are only limited once a
+# service tells us they are exhausted.
+DEFAULT_RATE_LIMITS = {
+    ('facebook', 'graph'): (600, 1.0),
+    ('twitter', 'users/lookup'): (180, 180 / 900.0),
+    ('twitter', 'users/show'): (150, 150 / 3600.0),
+}
+
+
+class Governor(object):
+    """
+    Keeps a token bucket per service and endpoint so that calls to external
+    services stay within their quotas. Buckets live in a Django cache so that
+    processes sharing that cache (e.g., a memcached on the same machine) share
+    their quotas; updates are serialized within a process only, so across
+    processes the accounting is approximate.
+
+    What remains of a quota is also learned from the headers of each
+    response, and a refused request (HTTP 429, or Twitter's 400 with an
+    exhausted quota) empties the bucket until the service says it resets.
+
+    Essential calls wait up to ``wait`` seconds for a token; anything else
+    is refused immediately so that optional work is shed first.
+
+    """
+    def __init__(self, limits=None, wait=2, backoff=60, cache_name=None):
+        self.limits = limits is None and DEFAULT_RATE_LIMITS or limits
+        self.wait = wait
+        self.backoff = backoff
+        self.cache = cache_name and get_cache(cache_name) or cache
+        self.lock = threading.Lock()
+
+    def key(self, service, endpoint):
+        return 'social_registration:ratelimit:%s:%s' % (service, endpoint)
+
+    def take(self, service, endpoint):
+        """
+        Take a token from a bucket, returning how many seconds to wait before
+        trying again if there was none.
+
+        """
+        capacity, rate = self.limits.get((service, endpoint), (None, None))
+        key = self.key(service, endpoint)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            bucket = self.cache.get(key) or {'tokens': capacity, 'updated': now, 'blocked_until': 0}
+            if bucket['blocked_until']:
+                if now < bucket['blocked_until']:
+                    # Spend what the service told us remains until it resets.
+                    if not bucket['tokens'] or bucket['tokens'] < 1:
+                        return bucket['blocked_until'] - now
+                    bucket['tokens'] -= 1
+                    self.cache.set(key, bucket, 3600)
+                    return 0
+                bucket.update(tokens=capacity, updated=now, blocked_until=0)
+                self.cache.set(key, bucket, 3600)
+            if capacity is None:
+                return 0
+
+            tokens = min(capacity, bucket['tokens'] + (now - bucket['updated']) * rate)
+            if tokens < 1:
+                delay = (1 - tokens) / rate
+            else:
+                delay = 0
+                tokens -= 1
+            bucket.update(tokens=tokens, updated=now)
+            self.cache.set(key, bucket, 3600)
+            return delay
+        finally:
+            self.lock.release()
+
+    def acquire(self, service, endpoint, essential=True):
+        """
+        Wait for permission to call an endpoint, raising ``RateLimited`` if it
+        is not granted in time.
+
+        """
+        deadline = time.time() + (essential and self.wait or 0)
+        while True:
+            delay = self.take(service, endpoint)
+            if not delay:
+                return
+            if time.time() + delay > deadline:
+                raise RateLimited('The %s quota for %s is exhausted.' % (service, endpoint), delay)
+            time.sleep(delay)
+
+    def learn(self, service, endpoint, status, headers):
+        """
+        Update a bucket from the status and headers of a response.
+
+        """
+        remaining = reset = None
+        if 'x-ratelimit-remaining' in headers:
+            remaining = int(headers['x-ratelimit-remaining'])
+            reset = int(headers.get('x-ratelimit-reset', 0)) or None
+        elif 'x-app-usage' in headers:
+            # Facebook reports the percentage of the application's quota used.
+            usage = json.loads(headers['x-app-usage'])
+            if max(usage.values() or [0]) >= 100:
+                remaining = 0
+        if status == 429:
+            remaining = 0
+        if remaining is None:
+            return
+
+        key = self.key(service, endpoint)
+        self.lock.acquire()
+        try:
+            bucket = self.cache.get(key) or {'tokens': None, 'updated': time.time(), 'blocked_until': 0}
+            bucket['tokens'] = remaining
+            bucket['updated'] = time.time()
+            bucket['blocked_until'] = reset or time.time() + (not remaining and self.backoff or 0)
+            self.cache.set(key, bucket, 3600)
+        finally:
+            self.lock.release()
+
+
+governor = Governor(
+    limits=getattr(settings, 'SOCIAL_REGISTRATION_RATE_LIMITS', None),
+    wait=getattr(settings, 'SOCIAL_REGISTRATION_RATE_LIMIT_WAIT', 2),
+    cache_name=getattr(settings, 'SOCIAL_REGISTRATION_RATE_LIMIT_CACHE', None)
+)
+
@@ -0,0 +1,9 @@
+-- Case-insensitive username lookups (``username__iexact``) and prefix
+-- searches (``username__istartswith``, used by the admin) compare
+-- UPPER(username::text), which the plain username index cannot serve. The
+-- pattern operator class lets the index serve LIKE prefixes in any locale.
+CREATE INDEX auth_user_username_upper ON auth_user (UPPER(username::text) text_pattern_ops);
+
+-- The refresh_social_tokens command reads the tokens still worth renewing
+-- in the order they expire.
+CREATE INDEX social_registration_association_renewable ON social_registration_association (expires_at, id) WHERE is_active AND is_token_valid AND expires_at IS NOT NULL;
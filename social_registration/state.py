@@ -0,0 +1,75 @@
+import logging
+
+
+logger = logging.getLogger('social_registration.state')
+
+
+def log_session_size(request, step):
+    """
+    Logs, at debug level, the encoded size of the session after the given
+    step of an authentication or registration workflow.
+
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        size = len(request.session.encode(dict(request.session.items())))
+        logger.debug('Session is %d bytes after %s.', size, step)
+
+
+class RegistrationState(object):
+    """
+    Everything ``RegistrationBackend.register()`` needs to know about a user
+    who has authenticated with an external service but not yet registered,
+    kept in the session between the callback and the registration form.
+
+    It is stored as a flat, versioned tuple rather than a dictionary of
+    provider responses, keeping the session row small while it is rewritten
+    on every request until registration completes. Profiles are left to the
+    profile cache. ``expires_at`` is kept in ISO 8601 format.
+
+    """
+    session_key = 'social_registration'
+    version = 3
+
+    def __init__(self, service, identifier, access_token, access_token_secret='', screen_name='', expires_at=None):
+        self.service = service
+        self.identifier = identifier
+        self.access_token = access_token
+        self.access_token_secret = access_token_secret
+        self.screen_name = screen_name
+        self.expires_at = expires_at
+
+    def dumps(self):
+        return (self.version, self.service, self.identifier, self.access_token,
+            self.access_token_secret, self.screen_name, self.expires_at)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Rebuild a state from ``dumps()``, returning ``None`` if it was written
+        by an incompatible version.
+
+        """
+        if not data or data[0] != cls.version:
+            return None
+        return cls(*data[1:])
+
+    def save(self, request):
+        request.session[self.session_key] = self.dumps()
+        log_session_size(request, '%s authentication' % self.service)
+
+    @classmethod
+    def load(cls, request, service):
+        """
+        Return the state stored in the session for the given service, or
+        ``None`` if there is none.
+
+        """
+        state = cls.loads(request.session.get(cls.session_key))
+        if state is None or state.service != service:
+            return None
+        return state
+
+    @classmethod
+    def clear(cls, request):
+        request.session.pop(cls.session_key, None)
+
@@ -0,0 +1,232 @@
+import datetime
+import json
+import logging
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.importlib import import_module
+
+
+logger = logging.getLogger('social_registration.tasks')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def resolve(path):
+    """
+    Return the object found at the given dotted Python import path.
+
+    """
+    i = path.rfind('.')
+    module, attr = path[:i], path[i+1:]
+    try:
+        return getattr(import_module(module), attr)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error loading task %s: "%s"' % (path, e))
+
+
+def run(path, args, kwargs):
+    return resolve(path)(*args, **kwargs)
+
+
+class ImmediateExecutor(object):
+    """
+    Runs each task as soon as it is submitted, in the calling thread. Useful
+    in development and tests where deferring work only gets in the way.
+
+    """
+    delay = 0
+
+    def __init__(self, attempts=3):
+        self.attempts = attempts
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    def execute(self, path, args, kwargs):
+        """
+        Run a task, retrying it up to ``attempts`` times and waiting an
+        exponentially increasing multiple of ``delay`` seconds in between.
+
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                run(path, args, kwargs)
+            except Exception:
+                logger.exception('Task %s failed (attempt %d of %d).', path, attempt, self.attempts)
+                if attempt < self.attempts:
+                    self.retried += 1
+                    time.sleep(self.delay * 2 ** (attempt - 1))
+                continue
+            self.completed += 1
+            return
+        self.failed += 1
+
+    def submit(self, path, args, kwargs):
+        self.execute(path, args, kwargs)
+
+    def queue_depth(self):
+        return 0
+
+    def stats(self):
+        return {
+            'completed': self.completed,
+            'depth': self.queue_depth(),
+            'failed': self.failed,
+            'retried': self.retried
+        }
+
+
+class ThreadExecutor(ImmediateExecutor):
+    """
+    Runs tasks on a small pool of in-process daemon threads so the request
+    that submitted them can return straight away. Tasks that are still queued
+    when the process exits are lost, which is acceptable for the refreshes
+    this is used for.
+
+    """
+    delay = 1
+
+    def __init__(self, attempts=3, workers=2):
+        super(ThreadExecutor, self).__init__(attempts)
+        self.queue = Queue.Queue()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work, name='social-registration-task-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            path, args, kwargs = self.queue.get()
+            try:
+                self.execute(path, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, path, args, kwargs):
+        self.queue.put((path, args, kwargs))
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+
+class DatabaseExecutor(ImmediateExecutor):
+    """
+    Stores tasks as ``Task`` rows to be run by the ``process_social_tasks``
+    management command, so they survive restarts and can be worked off by
+    separate processes. Failed tasks are retried with an increasing delay
+    and marked as failed once they run out of attempts.
+
+    """
+    def submit(self, path, args, kwargs):
+        from social_registration.models import Task
+
+        Task.objects.create(path=path, arguments=json.dumps([args, kwargs]))
+
+    def run_pending(self, limit=100):
+        """
+        Run up to ``limit`` tasks that are due, returning how many were run.
+
+        """
+        from social_registration.models import Task
+
+        count = 0
+        now = timezone.now()
+        for task in Task.objects.filter(is_failed=False, available_at__lte=now).order_by('available_at')[:limit]:
+            # Claim the task so that concurrent runners skip it.
+            claimed = Task.objects.filter(pk=task.pk, attempts=task.attempts).update(
+                attempts=task.attempts + 1,
+                available_at=now + datetime.timedelta(seconds=60 * 2 ** task.attempts)
+            )
+            if not claimed:
+                continue
+            count += 1
+            args, kwargs = json.loads(task.arguments)
+            try:
+                run(task.path, args, dict((str(k), v) for k, v in kwargs.items()))
+            except Exception, e:
+                logger.exception('Task %s failed (attempt %d of %d).', task.path, task.attempts + 1, self.attempts)
+                Task.objects.filter(pk=task.pk).update(
+                    is_failed=task.attempts + 1 >= self.attempts,
+                    last_error=unicode(e)
+                )
+                if task.attempts + 1 >= self.attempts:
+                    self.failed += 1
+                else:
+                    self.retried += 1
+                continue
+            task.delete()
+            self.completed += 1
+        return count
+
+    def queue_depth(self):
+        from social_registration.models import Task
+
+        return Task.objects.filter(is_failed=False).count()
+
+
+def get_executor():
+    """
+    Return the process-wide task executor named by the
+    ``SOCIAL_REGISTRATION_TASK_EXECUTOR`` setting, creating it on first use.
+
+    """
+    global _executor
+    if _executor is None:
+        _executor_lock.acquire()
+        try:
+            if _executor is None:
+                executor_class = resolve(getattr(settings, 'SOCIAL_REGISTRATION_TASK_EXECUTOR',
+                    'social_registration.tasks.ThreadExecutor'))
+                kwargs = {'attempts': getattr(settings, 'SOCIAL_REGISTRATION_TASK_ATTEMPTS', 3)}
+                if issubclass(executor_class, ThreadExecutor):
+                    kwargs['workers'] = getattr(settings, 'SOCIAL_REGISTRATION_TASK_WORKERS', 2)
+                _executor = executor_class(**kwargs)
+        finally:
+            _executor_lock.release()
+    return _executor
+
+
+def defer(path, *args, **kwargs):
+    """
+    Submit the function at the given dotted path to be called later with the
+    given arguments, which must be serializable as JSON.
+
+    """
+    get_executor().submit(path, args, kwargs)
+
+
+def send_user_registered(sender, user_id):
+    """
+    Sends the ``user_registered`` signal outside of the registration request.
+    Receivers are given ``request=None``.
+
+    """
+    from django.contrib.auth.models import User
+    from registration import signals
+
+    signals.user_registered.send(sender=resolve(sender), user=User.objects.get(pk=user_id), request=None)
+
+
+def notify_user_registered(sender, user, request):
+    """
+    Sends the ``user_registered`` signal for a newly registered user, or
+    defers it to ``send_user_registered`` when the
+    ``SOCIAL_REGISTRATION_DEFER_SIGNALS`` setting is enabled.
+
+    """
+    from registration import signals
+
+    if getattr(settings, 'SOCIAL_REGISTRATION_DEFER_SIGNALS', False):
+        defer('social_registration.tasks.send_user_registered',
+            '%s.%s' % (sender.__module__, sender.__name__), user.pk)
+    else:
+        signals.user_registered.send(sender=sender, user=user, request=request)
+
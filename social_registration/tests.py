@@ -0,0 +1,707 @@
+"""
+Tests for the workflows, their query budgets and the commands that maintain
+associations. Twitter and Facebook are answered by stand-ins for the
+transport rather than called.
+
+The tests are run from a project, as ``manage.py test social_registration``,
+since the views need its ``accounts`` application.
+
+"""
+import json
+import os
+import tempfile
+import time
+import urlparse
+
+from StringIO import StringIO
+
+from django.conf.urls.defaults import include, patterns, url
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from social_registration import queries, tasks
+from social_registration.admin import AssociationAdmin
+from social_registration.backends.twitter import AccountBackend as TwitterAccountBackend
+from social_registration.backends.twitter import AuthenticationBackend as TwitterAuthenticationBackend
+from social_registration.cache import association_cache
+from social_registration.circuit import CircuitBreaker
+from social_registration.exceptions import RateLimited
+from social_registration.flow import CacheFlowStore
+from social_registration.forms import UserForm
+from social_registration.models import Association, Task, connect_last_login
+from social_registration.profiles import profile_cache
+from social_registration.queries import QueryLog
+from social_registration.ratelimit import Governor
+from social_registration.state import RegistrationState
+from social_registration.usernames import suggest_usernames
+from social_registration.transport import transport
+
+
+def home(request):
+    return HttpResponse('')
+
+
+urlpatterns = patterns('',
+
+    url(r'^$',
+        view    = home,
+        name    = 'site-home'
+    ),
+    url(r'^profile/$',
+        view    = home,
+        name    = 'edit-profile'
+    ),
+    (r'^', include('social_registration.backends.default.urls')),
+    (r'^', include('social_registration.backends.facebook.urls')),
+    (r'^', include('social_registration.backends.twitter.urls')),
+
+)
+
+
+# The views each service calls back, and the answers it gives to each of its
+# endpoints, keyed by the last part of the path. ``%(identifier)s`` is the
+# user logging in.
+AUTHENTICATE_URLS = {
+    'facebook': 'facebook-authentication',
+    'twitter': 'twitter-authenticate'
+}
+
+RESPONSES = {
+    ('facebook', 'access_token'): 'access_token=facebook%(identifier)s&expires=5183999',
+    ('facebook', ''): json.dumps([
+        {'code': 200, 'body': json.dumps({
+            'first_name': 'Test',
+            'id': '%(identifier)s',
+            'last_name': 'User',
+            'link': 'http://www.facebook.com/profile.php?id=%(identifier)s',
+            'name': 'Test User'
+        })},
+        {'code': 200, 'body': json.dumps({'data': {'url': 'http://example.com/%(identifier)s.jpg'}})}
+    ]),
+    ('twitter', 'access_token'): ('oauth_token=twitter%(identifier)s&oauth_token_secret=secret'
+        '&user_id=%(identifier)s&screen_name=test%(identifier)s'),
+    ('twitter', 'request_token'): 'oauth_token=request&oauth_token_secret=secret&oauth_callback_confirmed=true',
+    ('twitter', 'show.json'): json.dumps({
+        'id': '%(identifier)s',
+        'name': 'Test User',
+        'profile_image_url': 'http://example.com/%(identifier)s.png',
+        'screen_name': 'test%(identifier)s'
+    })
+}
+
+
+class ProviderTransport(object):
+    """
+    Stands in for ``social_registration.transport.transport``, answering as
+    Twitter and Facebook would for the user with ``identifier``.
+
+    """
+    def __init__(self):
+        self.identifier = None
+
+    def request(self, url, method='GET', body=None, headers=None, service=None, endpoint=None, essential=True,
+            idempotent=None):
+        content = RESPONSES[(service, urlparse.urlsplit(url).path.rsplit('/', 1)[-1])]
+        return 200, {}, content % {'identifier': self.identifier}
+
+
+# The values ``record_task()`` was called with, in order.
+task_calls = []
+
+
+def record_task(value, failures=0):
+    """
+    A task for the executors that fails the first ``failures`` times it is
+    called with ``value``.
+
+    """
+    task_calls.append(value)
+    if task_calls.count(value) <= failures:
+        raise ValueError('Failing %s.' % value)
+
+
+def associate(service, identifier, username):
+    user = User.objects.create_user(username, '%s@example.com' % username, 'password')
+    Association.objects.create(access_token='token', identifier=identifier, profile_url='http://example.com/',
+        service=service, user=user)
+    return user
+
+
+# Every backend that could answer a social login, as a project would list
+# them.
+AUTHENTICATION_BACKENDS = (
+    'django.contrib.auth.backends.ModelBackend',
+    'social_registration.backends.facebook.AuthenticationBackend',
+    'social_registration.backends.twitter.AuthenticationBackend',
+)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=AUTHENTICATION_BACKENDS)
+class AuthenticationBackendTests(TestCase):
+    """
+    With both services' backends enabled, a login is only looked up by the
+    backend of its own service.
+
+    """
+    def setUp(self):
+        self.cache_enabled, association_cache.enabled = association_cache.enabled, False
+
+    def tearDown(self):
+        association_cache.enabled = self.cache_enabled
+
+    def test_one_association_query_per_login(self):
+        for service, identifier in (('facebook', 4001), ('twitter', 4002)):
+            user = associate(service, identifier, 'user%d' % identifier)
+            with self.assertNumQueries(1):
+                self.assertEqual(authenticate(service=service, identifier=identifier), user)
+            with self.assertNumQueries(1):
+                self.assertEqual(authenticate(service=service, identifier=identifier + 10), None)
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=AUTHENTICATION_BACKENDS,
+    FACEBOOK_APPLICATION_ID='tests',
+    FACEBOOK_SECRET_KEY='tests',
+    SOCIAL_REGISTRATION_DEFER_SIGNALS=False,
+    TWITTER_KEY='tests',
+    TWITTER_SECRET='tests'
+)
+class WorkflowTestCase(TestCase):
+    """
+    Runs workflows through the views with the query budgets enforced, so
+    that a step which goes over its budget, or repeats a query, fails the
+    test with ``QueryBudgetExceeded``. Deferred work is queued with the
+    ``DatabaseExecutor``, as the budgets assume.
+
+    """
+    cache = False
+    urls = 'social_registration.tests'
+
+    def setUp(self):
+        self.budget_mode, queries.budget_mode = queries.budget_mode, 'raise'
+        self.cache_enabled, association_cache.enabled = association_cache.enabled, self.cache
+        connect_last_login(self.cache)
+        self.executor, tasks._executor = tasks._executor, tasks.DatabaseExecutor()
+        self.provider = ProviderTransport()
+        transport.request = self.provider.request
+        association_cache.local.clear()
+
+    def tearDown(self):
+        queries.budget_mode = self.budget_mode
+        association_cache.enabled = self.cache_enabled
+        association_cache.local.clear()
+        connect_last_login(self.cache_enabled)
+        tasks._executor = self.executor
+        del transport.request
+
+    def login(self, service, identifier):
+        """
+        Logs in as the given user of a service, through the ``prepare`` view
+        and then the ``authenticate`` view as the service would call it back,
+        returning the path the latter redirected to.
+
+        """
+        self.provider.identifier = identifier
+        response = self.client.get(reverse('%s-prepare' % service))
+        query = dict(urlparse.parse_qsl(urlparse.urlsplit(response['Location']).query))
+        response = self.client.get(reverse(AUTHENTICATE_URLS[service]), {
+            'code': 'tests',
+            'oauth_token': query.get('oauth_token', ''),
+            'oauth_verifier': 'tests'
+        })
+        self.assertEqual(response.status_code, 302)
+        return urlparse.urlsplit(response['Location']).path
+
+
+class QueryBudgetTests(WorkflowTestCase):
+    """
+    Each workflow, with the association cache off.
+
+    """
+    def test_grant(self):
+        for service, identifier in (('facebook', 1001), ('twitter', 1002)):
+            associate(service, identifier, 'user%d' % identifier)
+            # The second login is the one served from the cache, when on.
+            for i in range(2):
+                self.client.logout()
+                self.assertEqual(self.login(service, identifier), reverse('site-home'))
+                self.assertEqual(self.client.session['_auth_user_id'],
+                    Association.objects.get(identifier=identifier, service=service).user_id)
+        self.assertEqual(Association.objects.get(identifier=1002, service='twitter').access_token, 'twitter1002')
+
+    def test_create_and_register(self):
+        for service, identifier in (('facebook', 2001), ('twitter', 2002)):
+            self.client.logout()
+            self.assertEqual(self.login(service, identifier), reverse('%s-setup' % service))
+            response = self.client.post(reverse('%s-setup' % service), {
+                'email': 'user%d@example.com' % identifier,
+                'username': 'user%d' % identifier
+            })
+            self.assertEqual(response.status_code, 302)
+            association = Association.objects.get(identifier=identifier, service=service)
+            self.assertEqual(association.user.username, 'user%d' % identifier)
+
+    def test_link_and_deauthenticate(self):
+        associate('twitter', 3001, 'user3001')
+        self.assertEqual(self.login('twitter', 3001), reverse('site-home'))
+        self.assertEqual(self.login('facebook', 3002), reverse('edit-profile'))
+        self.assertEqual(Association.objects.get(identifier=3002, service='facebook').user.username, 'user3001')
+
+        self.client.get(reverse('facebook-deauthentication'))
+        self.assertFalse(Association.objects.get(identifier=3002, service='facebook').is_active)
+        self.client.logout()
+        self.assertEqual(self.login('facebook', 3002), reverse('facebook-setup'))
+
+
+class CachedQueryBudgetTests(QueryBudgetTests):
+    """
+    The same workflows with the association cache on.
+
+    """
+    cache = True
+
+    def test_grant(self):
+        hits = association_cache.hits
+        super(CachedQueryBudgetTests, self).test_grant()
+        # One hit for the second login with each service: neither the token
+        # nor the ``last_login`` written by the first dropped the entry.
+        self.assertEqual(association_cache.hits - hits, 2)
+
+
+@override_settings(TWITTER_KEY='tests', TWITTER_SECRET='tests')
+class RefreshSocialProfilesTests(TestCase):
+    """
+    The ``refresh_social_profiles`` command, two Twitter users at a time.
+
+    """
+    def setUp(self):
+        self.batch_size, TwitterAccountBackend.batch_size = TwitterAccountBackend.batch_size, 2
+        self.failing = set()
+        transport.request = self.request
+        fd, self.checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.checkpoint)
+
+    def tearDown(self):
+        TwitterAccountBackend.batch_size = self.batch_size
+        del transport.request
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def request(self, url, method='GET', body=None, headers=None, service=None, endpoint=None, essential=True,
+            idempotent=None):
+        identifiers = urlparse.parse_qs(urlparse.urlsplit(url).query)['user_id'][0].split(',')
+        if self.failing.intersection(identifiers):
+            return 500, {}, ''
+        return 200, {}, json.dumps([{
+            'id': int(identifier),
+            'profile_image_url': 'http://example.com/%s.png' % identifier,
+            'screen_name': 'test%s' % identifier
+        } for identifier in identifiers])
+
+    def refresh(self):
+        call_command('refresh_social_profiles', attempts=1, checkpoint=self.checkpoint, rate=0,
+            services=['twitter'], stdout=StringIO(), workers=1)
+
+    def test_refresh(self):
+        for identifier in range(5001, 5006):
+            associate('twitter', identifier, 'user%d' % identifier)
+        pks = list(Association.objects.order_by('pk').values_list('pk', flat=True))
+        self.failing.add('5003')
+        with QueryLog() as log:
+            self.refresh()
+
+        # One statement for each chunk that was fetched.
+        self.assertEqual(len([query for query in log.queries if query['sql'].startswith('UPDATE')]), 2)
+        avatars = dict(Association.objects.values_list('identifier', 'avatar'))
+        self.assertEqual(avatars[5001], 'http://example.com/5001.png')
+        self.assertEqual(avatars[5003], '')
+        self.assertEqual(avatars[5005], 'http://example.com/5005.png')
+        self.assertEqual(Association.objects.get(identifier=5002).profile_url, 'http://twitter.com/test5002')
+        self.assertEqual(profile_cache.peek('twitter', 5001), None)
+
+        # The checkpoint stops before the chunk that failed, which a resumed
+        # run tries again.
+        self.assertEqual(json.load(open(self.checkpoint)), {'twitter': pks[1]})
+        self.failing.clear()
+        self.refresh()
+        self.assertEqual(Association.objects.get(identifier=5003).avatar, 'http://example.com/5003.png')
+        self.assertEqual(json.load(open(self.checkpoint)), {'twitter': pks[4]})
+
+
+class RegistrationStateTests(WorkflowTestCase):
+    """
+    The state each service leaves in the session for the registration form
+    is rewritten on every request until the user registers, so it is kept
+    to the identifier, the tokens and the screen name: no provider response.
+
+    """
+    # The most bytes the state may add to the encoded session, for the
+    # tokens given by ``ProviderTransport``.
+    MAX_SIZES = {
+        'facebook': 150,
+        'twitter': 130
+    }
+
+    def test_size(self):
+        for service, identifier in (('facebook', 10001), ('twitter', 10002)):
+            self.assertEqual(self.login(service, identifier), reverse('%s-setup' % service))
+            session = self.client.session
+            data = session[RegistrationState.session_key]
+            self.assertEqual(RegistrationState.loads(data).identifier, str(identifier))
+            size = len(session.encode({RegistrationState.session_key: data})) - len(session.encode({}))
+            self.assertTrue(size <= self.MAX_SIZES[service],
+                'The %s registration state is %d bytes, over %d.' % (service, size, self.MAX_SIZES[service]))
+
+
+class AssociationCacheTests(TestCase):
+    """
+    The association cache keeps a user across the writes of a login, and
+    drops it when the association changes user or ``is_active``, or the user
+    or association is saved or deleted.
+
+    """
+    def setUp(self):
+        self.cache_enabled, association_cache.enabled = association_cache.enabled, True
+        association_cache.delete('twitter', 6001)
+        self.user = associate('twitter', 6001, 'user6001')
+        self.backend = TwitterAuthenticationBackend()
+        self.association = Association.objects.get(identifier=6001, service='twitter')
+
+    def tearDown(self):
+        association_cache.delete('twitter', 6001)
+        association_cache.enabled = self.cache_enabled
+
+    def is_cached(self):
+        return association_cache.get('twitter', 6001) is not None
+
+    def test_authenticate(self):
+        self.assertFalse(self.is_cached())
+        user = self.backend.authenticate(service='twitter', identifier=6001)
+        self.assertEqual(user.social_association_id, self.association.pk)
+        self.assertTrue(self.is_cached())
+        with self.assertNumQueries(0):
+            user = self.backend.authenticate(service='twitter', identifier=6001)
+        self.assertEqual((user, user.social_association_id), (self.user, self.association.pk))
+
+    def test_token_save(self):
+        self.backend.authenticate(service='twitter', identifier=6001)
+        self.association.access_token = 'renewed'
+        self.association.save()
+        self.assertTrue(self.is_cached())
+
+    def test_deactivate(self):
+        self.backend.authenticate(service='twitter', identifier=6001)
+        self.association.is_active = False
+        self.association.save()
+        self.assertFalse(self.is_cached())
+        self.assertEqual(self.backend.authenticate(service='twitter', identifier=6001), None)
+
+    def test_user_change(self):
+        self.backend.authenticate(service='twitter', identifier=6001)
+        self.association.user = User.objects.create_user('other', 'other@example.com')
+        self.association.save()
+        self.assertFalse(self.is_cached())
+        self.assertEqual(self.backend.authenticate(service='twitter', identifier=6001).username, 'other')
+
+    def test_user_save(self):
+        self.backend.authenticate(service='twitter', identifier=6001)
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        self.assertFalse(self.is_cached())
+
+    def test_delete(self):
+        self.backend.authenticate(service='twitter', identifier=6001)
+        self.association.delete()
+        self.assertFalse(self.is_cached())
+        self.assertEqual(self.backend.authenticate(service='twitter', identifier=6001), None)
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+
+    def wait_out(self):
+        self.breaker.get_circuit('twitter')['opened_at'] -= 30
+
+    def test_cycle(self):
+        self.breaker.failure('twitter')
+        self.assertEqual(self.breaker.state('twitter'), CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow('twitter'))
+        self.breaker.failure('twitter')
+        self.assertEqual(self.breaker.state('twitter'), CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow('twitter'))
+        # Other services are unaffected.
+        self.assertTrue(self.breaker.allow('facebook'))
+
+        # One probe is let through once the timeout is up; it failing opens
+        # the circuit again.
+        self.wait_out()
+        self.assertTrue(self.breaker.allow('twitter'))
+        self.assertEqual(self.breaker.state('twitter'), CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow('twitter'))
+        self.breaker.failure('twitter')
+        self.assertEqual(self.breaker.state('twitter'), CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow('twitter'))
+
+        # A probe that succeeds closes it.
+        self.wait_out()
+        self.assertTrue(self.breaker.allow('twitter'))
+        self.breaker.success('twitter')
+        self.assertEqual(self.breaker.state('twitter'), CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow('twitter'))
+        self.breaker.failure('twitter')
+        self.assertEqual(self.breaker.state('twitter'), CircuitBreaker.CLOSED)
+
+
+class GovernorTests(TestCase):
+
+    def setUp(self):
+        self.governor = Governor(limits={('tests', 'limited'): (2, 1.0)}, wait=0, backoff=60)
+        for endpoint in ('limited', 'unlimited'):
+            self.governor.cache.delete(self.governor.key('tests', endpoint))
+
+    def test_take(self):
+        self.assertEqual(self.governor.take('tests', 'limited'), 0)
+        self.assertEqual(self.governor.take('tests', 'limited'), 0)
+        # The bucket is empty, and refills at a token a second.
+        self.assertTrue(0 < self.governor.take('tests', 'limited') <= 1)
+        self.assertRaises(RateLimited, self.governor.acquire, 'tests', 'limited', essential=False)
+        for i in range(10):
+            self.assertEqual(self.governor.take('tests', 'unlimited'), 0)
+
+    def test_learn_remaining(self):
+        reset = int(time.time()) + 120
+        self.governor.learn('tests', 'unlimited', 200, {'x-ratelimit-remaining': '1', 'x-ratelimit-reset': str(reset)})
+        self.assertEqual(self.governor.take('tests', 'unlimited'), 0)
+        self.assertTrue(100 < self.governor.take('tests', 'unlimited') <= 120)
+        try:
+            self.governor.acquire('tests', 'unlimited')
+        except RateLimited, e:
+            self.assertTrue(100 < e.retry_after <= 120)
+        else:
+            self.fail('The exhausted quota was not enforced.')
+
+    def test_learn_refusal(self):
+        self.governor.learn('tests', 'limited', 429, {})
+        self.assertTrue(50 < self.governor.take('tests', 'limited') <= 60)
+
+    def test_learn_app_usage(self):
+        self.governor.learn('tests', 'limited', 200, {'x-app-usage': json.dumps({'call_count': 50})})
+        self.assertEqual(self.governor.take('tests', 'limited'), 0)
+        self.governor.learn('tests', 'limited', 200, {'x-app-usage': json.dumps({'call_count': 100})})
+        self.assertTrue(self.governor.take('tests', 'limited') > 0)
+
+    def test_learn_nothing(self):
+        self.governor.learn('tests', 'limited', 200, {'content-type': 'application/json'})
+        self.assertEqual(self.governor.take('tests', 'limited'), 0)
+        self.assertEqual(self.governor.take('tests', 'limited'), 0)
+
+
+class CacheFlowStoreTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.store = CacheFlowStore()
+
+    def start(self, key, value):
+        """
+        Saves the state of a workflow as a browser starts it, returning the
+        nonce cookie the browser is given.
+
+        """
+        request = self.factory.get('/')
+        self.store.save(request, key, value)
+        response = HttpResponse()
+        self.store.process_response(request, response)
+        return response.cookies[self.store.cookie_name].value
+
+    def callback(self, cookie=None):
+        if cookie is not None:
+            self.factory.cookies[self.store.cookie_name] = cookie
+        else:
+            self.factory.cookies.pop(self.store.cookie_name, None)
+        return self.factory.get('/')
+
+    def test_pop(self):
+        cookie = self.start('token', 'secret')
+        self.assertEqual(self.store.pop(self.callback(cookie), 'token'), 'secret')
+        self.assertEqual(self.store.pop(self.callback(cookie), 'token'), None)
+
+    def test_pop_without_nonce(self):
+        cookie = self.start('token', 'secret')
+        self.assertEqual(self.store.pop(self.callback(), 'token'), None)
+        self.assertEqual(self.store.pop(self.callback('forged'), 'token'), None)
+        # Another browser's nonce does not do either.
+        self.assertEqual(self.store.pop(self.callback(self.start('other', 'other')), 'token'), None)
+        self.assertEqual(self.store.pop(self.callback(cookie), 'token'), 'secret')
+
+
+class ExecutorTests(TestCase):
+
+    def setUp(self):
+        del task_calls[:]
+
+    def test_thread_executor(self):
+        executor = tasks.ThreadExecutor(attempts=3, workers=1)
+        executor.delay = 0
+        executor.submit('social_registration.tests.record_task', ['flaky'], {'failures': 2})
+        executor.submit('social_registration.tests.record_task', ['broken'], {'failures': 3})
+        executor.queue.join()
+        self.assertEqual(task_calls, ['flaky'] * 3 + ['broken'] * 3)
+        self.assertEqual(executor.stats(), {'completed': 1, 'depth': 0, 'failed': 1, 'retried': 4})
+
+    def test_database_executor(self):
+        executor = tasks.DatabaseExecutor(attempts=2)
+        executor.submit('social_registration.tests.record_task', ['flaky'], {'failures': 1})
+        executor.submit('social_registration.tests.record_task', ['broken'], {'failures': 2})
+        self.assertEqual(executor.queue_depth(), 2)
+
+        self.assertEqual(executor.run_pending(), 2)
+        self.assertEqual(executor.retried, 2)
+        # Failed tasks are retried later.
+        self.assertEqual(executor.run_pending(), 0)
+        Task.objects.update(available_at=timezone.now())
+
+        self.assertEqual(executor.run_pending(), 2)
+        self.assertEqual(task_calls, ['flaky', 'broken', 'flaky', 'broken'])
+        self.assertEqual((executor.completed, executor.failed), (1, 1))
+        task = Task.objects.get()
+        self.assertEqual((task.attempts, task.is_failed), (2, True))
+        self.assertEqual(executor.queue_depth(), 0)
+
+
+class UsernameTests(TestCase):
+    urls = 'social_registration.tests'
+
+    def setUp(self):
+        User.objects.create_user('taken', 'taken@example.com')
+        User.objects.create_user('TestUser', 'testuser@example.com')
+
+    def test_suggestions(self):
+        self.assertEqual(suggest_usernames('Taken', ['Test User']), ['Test_User', 'Taken1', 'Taken2'])
+        form = UserForm.for_profile('twitter:7001', ['Test User'])({'email': 'new@example.com', 'username': 'TAKEN'})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.suggestions, ['Test_User', 'TAKEN1', 'TAKEN2'])
+        form = UserForm.for_profile('twitter:7001', ['Test User'])({'email': 'new@example.com', 'username': 'free'})
+        self.assertTrue(form.is_valid())
+
+    def test_available(self):
+        for username, available in (('free', True), ('taken', False), ('TESTUSER', False), ('not valid', False)):
+            response = self.client.get(reverse('username-available'), {'username': username})
+            self.assertEqual(json.loads(response.content), {'available': available})
+
+
+class AssociationAdminTests(TestCase):
+
+    def setUp(self):
+        self.cache_enabled, association_cache.enabled = association_cache.enabled, True
+        self.backend = TwitterAuthenticationBackend()
+        for identifier in (8001, 8002, 8003):
+            association_cache.delete('twitter', identifier)
+            associate('twitter', identifier, 'user%d' % identifier)
+            self.backend.authenticate(service='twitter', identifier=identifier)
+        self.admin = AssociationAdmin(Association, None)
+        self.messages = []
+        self.admin.message_user = lambda request, message: self.messages.append(message)
+
+    def tearDown(self):
+        for identifier in (8001, 8002, 8003):
+            association_cache.delete('twitter', identifier)
+        association_cache.enabled = self.cache_enabled
+
+    def test_deactivate_and_reactivate(self):
+        selected = Association.objects.filter(identifier__in=[8001, 8002])
+        # A batch of keys, the end of them, and the update.
+        with self.assertNumQueries(3):
+            self.admin.deactivate(None, selected)
+        self.assertEqual(self.messages, ['2 associations were deactivated.'])
+        self.assertEqual(list(Association.objects.filter(is_active=True).values_list('identifier', flat=True)),
+            [8003])
+        self.assertEqual(association_cache.get('twitter', 8001), None)
+        self.assertEqual(association_cache.get('twitter', 8002), None)
+        self.assertEqual(association_cache.get('twitter', 8003).username, 'user8003')
+
+        # Inactive associations are never cached, so there is nothing to drop.
+        with self.assertNumQueries(1):
+            self.admin.reactivate(None, selected)
+        self.assertEqual(self.messages[-1], '2 associations were reactivated.')
+        self.assertEqual(Association.objects.filter(is_active=True).count(), 3)
+
+
+class ExportImportTests(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.checkpoint = '%s.checkpoint' % self.path
+        for identifier in (9001, 9002, 9003):
+            associate('twitter', identifier, 'user%d' % identifier)
+        Association.objects.filter(identifier=9002).update(access_token_secret='secret', is_token_valid=False)
+
+    def tearDown(self):
+        for path in (self.path, self.checkpoint):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def export(self, **options):
+        call_command('export_associations', self.path, batch_size=2, checkpoint=self.checkpoint,
+            stdout=StringIO(), **options)
+        return [json.loads(line) for line in open(self.path)]
+
+    def load(self, **options):
+        call_command('import_associations', self.path, batch_size=2, checkpoint=self.checkpoint,
+            stdout=StringIO(), **options)
+        return json.load(open(self.checkpoint))
+
+    def values(self):
+        return list(Association.objects.order_by('identifier').values_list('service', 'identifier',
+            'user__username', 'access_token', 'access_token_secret', 'expires_at', 'avatar', 'profile_url',
+            'is_active', 'is_token_valid'))
+
+    def test_tokens(self):
+        records = self.export()
+        self.assertEqual(len(records), 3)
+        self.assertFalse('access_token' in records[0])
+        os.remove(self.checkpoint)
+        records = self.export(include_tokens=True)
+        self.assertEqual((records[1]['access_token'], records[1]['access_token_secret']), ('token', 'secret'))
+
+    def test_round_trip(self):
+        expected = self.values()
+        self.export(include_tokens=True)
+
+        # A resumed export only adds what follows its checkpoint.
+        associate('facebook', 9004, 'user9004')
+        records = self.export(include_tokens=True)
+        self.assertEqual([record['identifier'] for record in records], [9001, 9002, 9003, 9004])
+        expected = self.values()
+
+        os.remove(self.checkpoint)
+        lines = open(self.path).readlines()
+        open(self.path, 'w').writelines(lines[:2])
+        Association.objects.all().delete()
+        self.assertEqual(self.load(), {'created': 2, 'offset': os.path.getsize(self.path), 'read': 2,
+            'skipped': 0, 'unchanged': 0, 'updated': 0})
+
+        # A resumed import only reads what was added to the file since.
+        open(self.path, 'a').writelines(lines[2:])
+        progress = self.load()
+        self.assertEqual((progress['read'], progress['created']), (4, 4))
+        self.assertEqual(self.values(), expected)
+
+        # Importing again changes nothing.
+        os.remove(self.checkpoint)
+        self.assertEqual(self.load()['unchanged'], 4)
+        Association.objects.filter(identifier=9001).update(avatar='http://example.com/old.png', is_active=False)
+        os.remove(self.checkpoint)
+        self.assertEqual(self.load()['updated'], 1)
+        self.assertEqual(self.values(), expected)
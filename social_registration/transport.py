@@ -0,0 +1,211 @@
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+from django.conf import settings
+
+from social_registration.circuit import breaker
+from social_registration.exceptions import ProviderError, ProviderUnavailable
+from social_registration.ratelimit import governor
+
+
+def is_closed(error):
+    """
+    Return whether an error on a pooled connection means the remote end had
+    closed it while it sat idle, rather than the request itself failing. A
+    timeout never does.
+
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+class Transport(object):
+    """
+    A small HTTP client shared by the account backends for every call made to
+    an external service. Connections are kept alive and pooled per host so
+    that a login does not pay for fresh DNS, TCP and TLS handshakes, and both
+    connecting and reading are bounded by timeouts.
+
+    Latency is recorded per host and available from ``stats()``. Requests
+    that name the service and endpoint they call are metered by the rate
+    limit ``governor`` and guarded by the circuit ``breaker``.
+
+    """
+    def __init__(self, connect_timeout=5, read_timeout=10, pool_size=4):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.pools = {}
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, host, port):
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def acquire(self, key):
+        """
+        Return an idle connection for ``key`` and whether it was reused, or
+        open a new one if the pool is empty.
+
+        """
+        self.lock.acquire()
+        try:
+            pool = self.pools.setdefault(key, [])
+            if pool:
+                return pool.pop(), True
+        finally:
+            self.lock.release()
+        return self.connect(*key), False
+
+    def release(self, key, connection):
+        self.lock.acquire()
+        try:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def record(self, host, duration, failed=False):
+        self.lock.acquire()
+        try:
+            stats = self.latency.setdefault(host, {
+                'errors': 0,
+                'max': 0.0,
+                'requests': 0,
+                'total': 0.0
+            })
+            stats['requests'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            if failed:
+                stats['errors'] += 1
+        finally:
+            self.lock.release()
+
+    def request(self, url, method='GET', body=None, headers=None, service=None, endpoint=None, essential=True,
+            idempotent=None):
+        """
+        Perform a request and return a tuple of the response status (as an
+        integer), a dictionary of lower-cased response headers and the body.
+
+        If ``service`` and ``endpoint`` are given the request first waits for
+        the governor's permission, raising ``RateLimited`` if none is granted,
+        and its response is used to learn the remaining quota. While the
+        service's circuit is open ``ProviderUnavailable`` is raised without
+        making the request; connection errors, timeouts and server errors
+        count towards opening it.
+
+        Connection errors and timeouts are raised as ``ProviderError``.
+
+        A pooled connection that turns out to have been closed by the remote
+        end (it is reset, or answers without a status line) is discarded and
+        the request retried once on a fresh one, provided it is
+        ``idempotent``: by default only ``GET`` and ``HEAD`` requests are,
+        and one-shot calls such as exchanging an authorization code should
+        pass ``idempotent=False``. Timeouts are never retried.
+
+        """
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (parts.scheme == 'https' and 443 or 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+
+        if service is not None:
+            if not breaker.allow(service):
+                raise ProviderUnavailable('%s is unavailable.' % service)
+            governor.acquire(service, endpoint, essential)
+
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+
+        start = time.time()
+        try:
+            connection, reused = self.acquire(key)
+            while True:
+                try:
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                    content = response.read()
+                except (httplib.HTTPException, socket.error), e:
+                    connection.close()
+                    if not (reused and idempotent and is_closed(e)):
+                        raise
+                    connection, reused = self.connect(*key), False
+                    continue
+                break
+        except (httplib.HTTPException, socket.error), e:
+            self.record(parts.hostname, time.time() - start, failed=True)
+            if service is not None:
+                breaker.failure(service)
+            raise ProviderError('Request to %s failed: %s' % (parts.hostname, e))
+        self.record(parts.hostname, time.time() - start)
+        if service is not None:
+            if response.status >= 500:
+                breaker.failure(service)
+            else:
+                breaker.success(service)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(key, connection)
+        response_headers = dict(response.getheaders())
+        if service is not None:
+            governor.learn(service, endpoint, response.status, response_headers)
+        return response.status, response_headers, content
+
+    def warm(self, urls):
+        """
+        Open a pooled connection to the host of each of the given URLs ahead
+        of the first request that needs it, e.g. when a worker starts.
+
+        """
+        for url in urls:
+            parts = urlparse.urlsplit(url)
+            port = parts.port or (parts.scheme == 'https' and 443 or 80)
+            key = (parts.scheme, parts.hostname, port)
+            try:
+                self.release(key, self.connect(*key))
+            except (httplib.HTTPException, socket.error):
+                pass
+
+    def stats(self):
+        """
+        Return the request count, error count, and total, mean and maximum
+        latency in seconds for each host contacted.
+
+        """
+        self.lock.acquire()
+        try:
+            stats = {}
+            for host, values in self.latency.items():
+                stats[host] = dict(values, mean=values['total'] / values['requests'])
+            return stats
+        finally:
+            self.lock.release()
+
+
+transport = Transport(
+    connect_timeout=getattr(settings, 'SOCIAL_REGISTRATION_HTTP_CONNECT_TIMEOUT', 5),
+    read_timeout=getattr(settings, 'SOCIAL_REGISTRATION_HTTP_READ_TIMEOUT', 10),
+    pool_size=getattr(settings, 'SOCIAL_REGISTRATION_HTTP_POOL_SIZE', 4)
+)
+
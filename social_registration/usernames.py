@@ -0,0 +1,180 @@
+import array
+import hashlib
+import logging
+import math
+import operator
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Q
+
+
+logger = logging.getLogger('social_registration.usernames')
+
+
+def is_taken(username):
+    """
+    Return whether a username is taken, ignoring case. On PostgreSQL the
+    lookup is served by the ``UPPER(username)`` index created from
+    ``sql/association.postgresql_psycopg2.sql``.
+
+    """
+    return User.objects.filter(username__iexact=username).exists()
+
+
+def get_candidates(username, names):
+    """
+    Return alternatives to a username that is taken, best first: usernames
+    made from the given names (e.g., a screen name, or a first and last name
+    from a profile), then the username and those names with numeric
+    suffixes.
+
+    """
+    bases = []
+    for name in names:
+        if not name:
+            continue
+        bases.append(re.sub(r'\W+', '', name))
+        bases.append(re.sub(r'\W+', '_', name).strip('_'))
+
+    candidates = list(bases)
+    for base in [username] + bases[:2]:
+        candidates.extend(['%s%d' % (base, i) for i in range(1, 10)])
+
+    seen = set([username.lower()])
+    unique = []
+    for candidate in candidates:
+        # Usernames are limited to 30 characters by ``User``.
+        candidate = candidate[:30]
+        if candidate and candidate.lower() not in seen:
+            seen.add(candidate.lower())
+            unique.append(candidate)
+    return unique
+
+
+def suggest_usernames(username, names, key=None, limit=3):
+    """
+    Return up to ``limit`` available alternatives to a username that is
+    taken, checking every candidate in a single query. If a ``key``
+    identifying the profile the names came from is given, which candidates
+    are taken is cached for a minute so that repeated attempts from the same
+    user do not query again.
+
+    """
+    candidates = get_candidates(username, names)
+    if not candidates:
+        return []
+
+    cache_key = key and 'social_registration:suggestions:%s:%s' % (key, hashlib.md5(username.lower().encode('utf-8')).hexdigest())
+    taken = cache_key and cache.get(cache_key)
+    if taken is None:
+        query = reduce(operator.or_, [Q(username__iexact=candidate) for candidate in candidates])
+        taken = set(name.lower() for name in User.objects.filter(query).values_list('username', flat=True))
+        if cache_key:
+            cache.set(cache_key, taken, 60)
+    return [candidate for candidate in candidates if candidate.lower() not in taken][:limit]
+
+
+class BloomFilter(object):
+    """
+    A fixed-size set that answers membership queries with no false negatives
+    and a false positive rate of about ``error_rate`` once ``capacity`` items
+    have been added.
+
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = array.array('B', [0]) * (self.size // 8 + 1)
+
+    def positions(self, value):
+        digest = hashlib.md5(value.encode('utf-8')).hexdigest()
+        a, b = int(digest[:16], 16), int(digest[16:], 16)
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        for position in self.positions(value):
+            if not self.bits[position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+
+class UsernameIndex(object):
+    """
+    An in-process Bloom filter of every username taken (lower-cased), used to
+    answer "is this username free?" without a query when the answer is
+    definitely yes. A username the filter may contain is checked against the
+    database.
+
+    The filter is built in a background thread and rebuilt every
+    ``timeout`` seconds to pick up users created by other processes; until
+    the first build completes every check goes to the database. Because of
+    that lag it is only used for hints such as the availability view, never
+    for validating a registration.
+
+    """
+    def __init__(self, enabled=False, capacity=1000000, error_rate=0.01, timeout=3600):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.timeout = timeout
+        self.filter = None
+        self.built_at = 0
+        self.building = False
+        self.lock = threading.Lock()
+
+    def build(self):
+        try:
+            bloom = BloomFilter(max(self.capacity, User.objects.count() * 2), self.error_rate)
+            usernames = User.objects.values_list('username', flat=True).iterator()
+            for i, username in enumerate(usernames):
+                bloom.add(username.lower())
+                if not i % 10000:
+                    # Hashing millions of usernames never waits on I/O, so
+                    # give way now and then; under gevent this build would
+                    # otherwise hold up every request in the worker.
+                    time.sleep(0)
+            self.filter = bloom
+            self.built_at = time.time()
+        except Exception:
+            logger.exception('Failed to build the username index.')
+        self.building = False
+
+    def refresh(self):
+        self.lock.acquire()
+        try:
+            if self.building or time.time() - self.built_at < self.timeout:
+                return
+            self.building = True
+        finally:
+            self.lock.release()
+        thread = threading.Thread(target=self.build)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, username):
+        if self.filter is not None:
+            self.filter.add(username.lower())
+
+    def is_available(self, username):
+        if self.enabled:
+            self.refresh()
+            if self.filter is not None and username.lower() not in self.filter:
+                return True
+        return not is_taken(username)
+
+
+username_index = UsernameIndex(
+    enabled=getattr(settings, 'SOCIAL_REGISTRATION_USERNAME_INDEX', False),
+    capacity=getattr(settings, 'SOCIAL_REGISTRATION_USERNAME_INDEX_CAPACITY', 1000000),
+    timeout=getattr(settings, 'SOCIAL_REGISTRATION_USERNAME_INDEX_TIMEOUT', 3600)
+)
+
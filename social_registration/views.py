@@ -1,16 +1,40 @@
+import json
+import re
+
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login as standard_login
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.views.decorators.cache import never_cache
 from django.views.generic import simple
 
-from accounts.backends import get_backend
+from social_registration.backends import get_backend
+from social_registration.exceptions import ProviderError, ProviderUnavailable
+from social_registration.flow import flow_store
+from social_registration.instrumentation import timed
+from social_registration.queries import query_budget
+from social_registration.usernames import username_index
 from accounts.forms import ExtendedAuthenticationForm
 
 
+def provider_error(request, backend, unavailable=False):
+    """
+    Tells the user that the external service could not be reached, or
+    refused the request, and sends them back to try again later.
+
+    """
+    if unavailable:
+        messages.error(request, '%s appears to be down at the moment. Please try again later, '
+            'or log in with your username and password.' % backend.service.title())
+    else:
+        messages.error(request, 'We could not reach %s. Please try again in a few minutes.' % backend.service.title())
+    to, args, kwargs = backend.provider_error_redirect(request)
+    return redirect(to, *args, **kwargs)
+
+
 def prepare(request, backend, **kwargs):
     """
     Handles a redirection to the returned URL from the given backend for use
@@ -20,7 +44,17 @@ def prepare(request, backend, **kwargs):
 
     """
     backend = get_backend(backend)
-    return redirect(backend.prepare(request))
+    with timed(backend.service, 'prepare') as timing:
+        try:
+            response = redirect(backend.prepare(request))
+            flow_store.process_response(request, response)
+            return response
+        except ProviderUnavailable:
+            timing.outcome = 'provider_unavailable'
+            return provider_error(request, backend, unavailable=True)
+        except ProviderError:
+            timing.outcome = 'provider_error'
+            return provider_error(request, backend)
 
 
 def authenticate(request, backend, **kwargs):
@@ -29,16 +63,36 @@ def authenticate(request, backend, **kwargs):
     Depending on what is returned a user will either be logged in, "linked" or
     created.
 
+    The whole view, and each step of the backend, is timed and reported to
+    the recorders in ``SOCIAL_REGISTRATION_RECORDERS``, along with which of
+    those it was. The queries of each step are checked against its budget
+    in ``social_registration.queries``.
+
     """
     backend = get_backend(backend)
-    user = backend.authenticate(request)
-
-    if user is not None:
-        return backend.grant_user(request, user)
-    elif request.user.is_authenticated():
-        return backend.link_user(request, user)
-    else:
-        return backend.create_user(request, user)
+    with timed(backend.service, 'authenticate') as timing:
+        try:
+            with query_budget('authenticate'):
+                user = backend.authenticate(request)
+        except ProviderUnavailable:
+            timing.outcome = 'provider_unavailable'
+            return provider_error(request, backend, unavailable=True)
+        except ProviderError:
+            timing.outcome = 'provider_error'
+            return provider_error(request, backend)
+
+        if user is not None:
+            timing.outcome = 'grant'
+            with query_budget('grant'):
+                return backend.grant_user(request, user)
+        elif request.user.is_authenticated():
+            timing.outcome = 'link'
+            with query_budget('link'):
+                return backend.link_user(request, user)
+        else:
+            timing.outcome = 'create'
+            with query_budget('create'):
+                return backend.create_user(request, user)
 
 
 @login_required
@@ -49,10 +103,27 @@ def deauthenticate(request, backend, **kwargs):
 
     """
     backend = get_backend(backend)
-    success = backend.deauthenticate(request)
+    with query_budget('deauthenticate'):
+        success = backend.deauthenticate(request)
     return redirect('edit-profile')
 
 
+@never_cache
+def username_available(request):
+    """
+    Answers, as JSON, whether the username given in the ``username`` query
+    parameter is free, for use by the setup forms as the user types. Most
+    free usernames are recognised by ``username_index`` without a query.
+
+    """
+    username = request.GET.get('username', '')
+    if not re.match(r'^\w+$', username) or len(username) > 255:
+        available = False
+    else:
+        available = username_index.is_available(username)
+    return HttpResponse(json.dumps({'available': available}), mimetype='application/json')
+
+
 @never_cache
 def login(request, template_name='accounts/login.html',
     redirect_field_name=REDIRECT_FIELD_NAME,